@@ -1,8 +1,13 @@
 from telegram_datamanager.importer import Importer
+from telegram_datamanager.exporter import Exporter
 import json
 from telethon import TelegramClient, sync
 from telegram_datamanager.progress import Progress
 from telegram_datamanager.folders import Folders
+from telegram_datamanager.dialogs import DialogCache
+from telegram_datamanager.ratelimit import RateLimiter
+from telegram_datamanager.cassette import RecordingClient
+import sys
 
 if __name__ == '__main__':
     # Parse config
@@ -17,9 +22,30 @@ if __name__ == '__main__':
     datastore_folder = config['datastore_folder']
     work_folder = config['work_folder']
     session_name = config['session_name']
+    concurrent_downloads = config.get('concurrent_downloads', 1)
+    parallel_chats = config.get('parallel_chats', 1)
+    single_pass = config.get('single_pass', False)
+    fast_new_content_check = config.get('fast_new_content_check', False)
+    commit_rows = config.get('commit_rows', 0)
+    commit_seconds = config.get('commit_seconds', 0)
+    in_place_db = config.get('in_place_db', False)
+    db_backup = config.get('db_backup', False)
+    epoch_dates = config.get('epoch_dates', False)
+    dedup_media = config.get('dedup_media', False)
+    resumable_downloads = config.get('resumable_downloads', False)
+    stage_in_datastore = config.get('stage_in_datastore', False)
+    progress_fps = config.get('progress_fps', 0)
+    metrics_path = config.get('metrics_path', None)
+    dialog_cache_path = config.get('dialog_cache_path', None)
+    dialog_cache_full_every = config.get('dialog_cache_full_every', 10)
+    record_cassette = config.get('record_cassette', None)
+    check_media_ids = config.get('check_media_ids', False)
+    fsck_apply = config.get('fsck_apply', False)
+    export_folder = config.get('export_folder', None)
+    rate_limits = config.get('rate_limits', None)
 
     # CLI
-    pg = Progress(3)
+    pg = Progress(3 + (parallel_chats if parallel_chats > 1 else 0), fps=progress_fps, plain=not sys.stdout.isatty())
 
     def download_progress_callback(recieved, total):
         pg.update_line(2, 'Downloading File {:,}/{:,}'.format(recieved, total))
@@ -35,13 +61,39 @@ if __name__ == '__main__':
         if line2:
             pg.update_line(2, line2)
 
+    def chat_progress_callback(lane, line):
+        pg.update_line(3 + lane, line)
+
     # Start client
     client = TelegramClient(session_name, api_id, api_hash)
     client.start()
 
-    chats_from_folder = Folders(client).get_dialog_ids_from_folder(folder_names)
+    # Record responses for offline replay in benchmarks
+    if record_cassette:
+        client = RecordingClient(client, record_cassette)
+
+    # Requests per second of each RPC class, shared by everything using the client
+    rate_limiter = RateLimiter(rate_limits)
 
-    chat_names = chat_names + chats_from_folder
+    dialog_cache = DialogCache(client, dialog_cache_path, rate_limiter, dialog_cache_full_every)
 
-    with Importer(client, datastore_folder, work_folder, display_callback, download_progress_callback, True) as im:
+    with Importer(client, datastore_folder, work_folder, display_callback, download_progress_callback, True, check_media_ids=check_media_ids, concurrent_downloads=concurrent_downloads,
+                  parallel_chats=parallel_chats, chat_progress_callback=chat_progress_callback, single_pass=single_pass,
+                  fast_new_content_check=fast_new_content_check, commit_rows=commit_rows, commit_seconds=commit_seconds,
+                  in_place_db=in_place_db, db_backup=db_backup, epoch_dates=epoch_dates, dedup_media=dedup_media,
+                  resumable_downloads=resumable_downloads, stage_in_datastore=stage_in_datastore,
+                  dialog_cache=dialog_cache, metrics_path=metrics_path, fsck_apply=fsck_apply, rate_limiter=rate_limiter) as im:
+        # Folders share the importer's entity names
+        chats_from_folder = Folders(client, dialog_cache, im.entity_cache, rate_limiter).get_dialog_ids_from_folder(folder_names)
+        chat_names = chat_names + chats_from_folder
         im.update_chats(allow_list=chat_names)
+
+    if record_cassette:
+        client.save()
+
+    # Export chats changed by this import
+    if export_folder:
+        with Exporter(datastore_folder, export_folder, display_callback) as ex:
+            ex.export_chats(allow_list=chat_names)
+
+    pg.close()
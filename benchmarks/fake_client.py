@@ -0,0 +1,292 @@
+from telethon import functions, types, utils
+from telethon.errors import FloodWaitError
+from telethon.sessions import StringSession
+from telethon.tl import custom
+from telegram_datamanager.tlutil import TotalList, OfflineClient
+from datetime import datetime, timedelta, timezone
+import asyncio
+import collections
+import os
+import random
+import time
+
+
+class _MessageIter:
+    # Works with both `for` and `async for`, like telethon.sync iterators
+    def __init__(self, client, chat, ids, page_size):
+        self._client = client
+        self._chat = chat
+        self._ids = ids
+        self._page_size = page_size
+
+    def _pages(self):
+        for start in range(0, len(self._ids), self._page_size):
+            yield self._ids[start:start + self._page_size]
+
+    def __iter__(self):
+        for page in self._pages():
+            self._client._run(self._client._rpc('get_history'))
+            for message_id in page:
+                yield self._client._make_message(self._chat, message_id)
+
+    async def __aiter__(self):
+        for page in self._pages():
+            await self._client._rpc('get_history')
+            for message_id in page:
+                yield self._client._make_message(self._chat, message_id)
+
+
+class _DownloadIter:
+    def __init__(self, client, media, offset, request_size):
+        self._client = client
+        self._media = media
+        self._offset = offset
+        self._request_size = request_size
+
+    def _chunks(self):
+        data = self._client._media_bytes(self._media)
+        for start in range(self._offset, len(data), self._request_size):
+            yield data[start:start + self._request_size]
+
+    def __iter__(self):
+        for chunk in self._chunks():
+            self._client._run(self._client._rpc('get_file'))
+            yield chunk
+
+    async def __aiter__(self):
+        for chunk in self._chunks():
+            await self._client._rpc('get_file')
+            yield chunk
+
+
+class FakeChat:
+    def __init__(self, index, kind, messages):
+        self.index = index
+        self.kind = kind
+        self.messages = messages
+
+        entity_id = 1000 + index
+        if kind == 'user':
+            self.entity = types.User(id=entity_id, first_name='User', last_name=str(index), access_hash=index)
+        elif kind == 'bot':
+            self.entity = types.User(id=entity_id, first_name='Bot', last_name=str(index), access_hash=index, bot=True,
+                                     bot_info_version=1)
+        elif kind == 'group':
+            self.entity = types.Chat(id=entity_id, title='Group {}'.format(index), photo=types.ChatPhotoEmpty(),
+                                     participants_count=10, date=None, version=1)
+        else:
+            self.entity = types.Channel(id=entity_id, title='Channel {}'.format(index), photo=types.ChatPhotoEmpty(),
+                                        date=None, access_hash=index, megagroup=kind == 'megagroup',
+                                        broadcast=kind == 'channel')
+        self.id = utils.get_peer_id(self.entity)
+        self.peer = utils.get_peer(self.entity)
+
+
+class FakeClient(OfflineClient):
+    # Stand-in for TelegramClient serving synthetic chats, nothing goes to the network
+    # Methods return results when called outside the event loop and coroutines inside it, like telethon.sync
+    #
+    # chats: number of chats, kinds cycle through user, group, channel, megagroup, bot
+    # messages: messages per chat, or a list with one count per chat
+    # media_ratio: share of messages with a photo or document
+    # document_ratio: share of media that are documents
+    # media_size: bytes of each document, photos are a tenth of it
+    # duplicate_ratio: share of media reusing one of a few shared documents, like forwarded stickers
+    # latency: seconds each RPC takes
+    # folders: number of dialog filters
+    # flood_waits: RPC name -> (rate, seconds), calls over rate per second raise FloodWaitError of seconds
+    _kinds = ('user', 'group', 'channel', 'megagroup', 'bot')
+    _page_size = 100
+
+    def __init__(self, chats=10, messages=1000, media_ratio=0.2, document_ratio=0.5, media_size=64 * 1024,
+                 duplicate_ratio=0.0, latency=0.0, folders=3, seed=0, flood_waits=None):
+        super().__init__(StringSession(), 1, 'fake')
+
+        if isinstance(messages, int):
+            messages = [messages] * chats
+        self.chats = [FakeChat(i, self._kinds[i % len(self._kinds)], messages[i]) for i in range(chats)]
+        self._chats_by_id = {chat.id: chat for chat in self.chats}
+
+        self._media_ratio = media_ratio
+        self._document_ratio = document_ratio
+        self._media_size = media_size
+        self._duplicate_ratio = duplicate_ratio
+        self._latency = latency
+        self._folders = folders
+        self._seed = seed
+        self._flood_waits = flood_waits if flood_waits else {}
+        # RPC name -> times of calls in the last second
+        self._recent_calls = {name: collections.deque() for name in self._flood_waits}
+        self._base_date = datetime(2020, 1, 1, tzinfo=timezone.utc)
+
+        # RPC name -> count
+        self.calls = {}
+        # RPC name -> flood waits raised
+        self.flood_waits = {}
+
+    async def _rpc(self, name):
+        self.calls[name] = self.calls.get(name, 0) + 1
+        if self._latency:
+            await asyncio.sleep(self._latency)
+        if name in self._flood_waits:
+            rate, seconds = self._flood_waits[name]
+            now = time.monotonic()
+            recent = self._recent_calls[name]
+            while recent and recent[0] <= now - 1:
+                recent.popleft()
+            recent.append(now)
+            if len(recent) > rate:
+                self.flood_waits[name] = self.flood_waits.get(name, 0) + 1
+                raise FloodWaitError(request=None, capture=seconds)
+
+    # Synthetic data
+    def _chat(self, entity):
+        if isinstance(entity, FakeChat):
+            return entity
+        if not isinstance(entity, int):
+            entity = utils.get_peer_id(entity)
+        return self._chats_by_id[entity]
+
+    def _make_media(self, chat, message_id):
+        rnd = random.Random('{}-{}-{}'.format(self._seed, chat.index, message_id))
+        if rnd.random() >= self._media_ratio:
+            return None
+
+        media_id = chat.index * 10 ** 9 + message_id
+        if rnd.random() < self._duplicate_ratio:
+            media_id = rnd.randrange(10)
+        date = self._base_date + timedelta(minutes=message_id)
+
+        if rnd.random() < self._document_ratio:
+            document = types.Document(id=media_id, access_hash=0, file_reference=b'', date=date,
+                                      mime_type='application/octet-stream', size=self._media_size, dc_id=1,
+                                      attributes=[types.DocumentAttributeFilename('file_{}.bin'.format(media_id))])
+            return types.MessageMediaDocument(document=document)
+
+        size = self._media_size // 10
+        photo = types.Photo(id=media_id, access_hash=0, file_reference=b'', date=date,
+                            sizes=[types.PhotoSize(type='x', w=800, h=600, size=size)], dc_id=1)
+        return types.MessageMediaPhoto(photo=photo)
+
+    def _make_message(self, chat, message_id):
+        message = types.Message(id=message_id, peer_id=chat.peer,
+                                date=self._base_date + timedelta(minutes=message_id),
+                                message='Message {} in chat {}'.format(message_id, chat.index),
+                                media=self._make_media(chat, message_id))
+        message._finish_init(self, {chat.id: chat.entity}, None)
+        return message
+
+    def _make_dialog(self, chat):
+        dialog = types.Dialog(peer=chat.peer, top_message=chat.messages, read_inbox_max_id=chat.messages,
+                              read_outbox_max_id=chat.messages, unread_count=0, unread_mentions_count=0,
+                              unread_reactions_count=0, unread_poll_votes_count=0,
+                              notify_settings=types.PeerNotifySettings())
+        message = self._make_message(chat, chat.messages) if chat.messages else None
+        return custom.Dialog(self, dialog, {chat.id: chat.entity}, message)
+
+    def _get_media_object(self, target):
+        media = getattr(target, 'media', target)
+        if isinstance(media, types.MessageMediaPhoto):
+            return media.photo
+        if isinstance(media, types.MessageMediaDocument):
+            return media.document
+        return media
+
+    def _media_bytes(self, media):
+        if isinstance(media, types.Photo):
+            size = media.sizes[-1].size
+        else:
+            size = media.size
+        block = media.id.to_bytes(8, 'little', signed=True)
+        return (block * (size // len(block) + 1))[:size]
+
+    def _media_filename(self, media):
+        if isinstance(media, types.Photo):
+            return 'photo_{}.jpg'.format(media.id)
+        return media.attributes[0].file_name
+
+    # TelegramClient API used by Importer and Folders
+    def get_me(self):
+        async def get_me():
+            await self._rpc('get_me')
+            return types.User(id=1, first_name='Bench', last_name='Mark', phone='0', username='bench', is_self=True)
+        return self._run(get_me())
+
+    def _sorted_dialogs(self):
+        # Newest top message first
+        return sorted((chat for chat in self.chats), key=lambda chat: -chat.messages)
+
+    def get_dialogs(self, limit=None, ignore_migrated=False, **kwargs):
+        async def get_dialogs():
+            chats = self._sorted_dialogs()
+            for _ in range(0, max(len(chats), 1), self._page_size):
+                await self._rpc('get_dialogs')
+            return [self._make_dialog(chat) for chat in chats][:limit]
+        return self._run(get_dialogs())
+
+    def iter_dialogs(self, limit=None, ignore_migrated=False, **kwargs):
+        return iter(self.get_dialogs(limit=limit))
+
+    def iter_messages(self, entity, limit=None, reverse=False, min_id=0, **kwargs):
+        chat = self._chat(entity)
+        ids = list(range(min_id + 1, chat.messages + 1))
+        if not reverse:
+            ids.reverse()
+        return _MessageIter(self, chat, ids[:limit], self._page_size)
+
+    def get_messages(self, entity, limit=1, reverse=False, min_id=0, **kwargs):
+        async def get_messages():
+            await self._rpc('get_messages')
+            chat = self._chat(entity)
+            ids = list(range(min_id + 1, chat.messages + 1))
+            if not reverse:
+                ids.reverse()
+            result = TotalList([self._make_message(chat, i) for i in (ids if limit is None else ids[:limit])])
+            result.total = chat.messages
+            return result
+        return self._run(get_messages())
+
+    def get_entity(self, entity):
+        async def get_entity():
+            await self._rpc('get_entity')
+            return self._chat(entity).entity
+        return self._run(get_entity())
+
+    def download_media(self, message, file=None, progress_callback=None, **kwargs):
+        async def download_media():
+            media = self._get_media_object(message)
+            if not isinstance(media, (types.Photo, types.Document)):
+                return None
+            await self._rpc('download_media')
+            data = self._media_bytes(media)
+            path = os.path.join(file, self._media_filename(media))
+            with open(path, 'wb') as f:
+                f.write(data)
+            if progress_callback:
+                progress_callback(len(data), len(data))
+            return path
+        return self._run(download_media())
+
+    def iter_download(self, file, offset=0, request_size=512 * 1024, **kwargs):
+        return _DownloadIter(self, self._get_media_object(file), offset, request_size)
+
+    def __call__(self, request, ordered=False):
+        async def call():
+            await self._rpc(type(request).__name__)
+            if isinstance(request, functions.contacts.GetContactsRequest):
+                users = [chat.entity for chat in self.chats if chat.kind == 'user']
+                contacts = [types.Contact(user_id=user.id, mutual=True) for user in users[::2]]
+                return types.contacts.Contacts(contacts=contacts, saved_count=0, users=users[::2])
+            if isinstance(request, functions.messages.GetDialogFiltersRequest):
+                return self._make_dialog_filters()
+            raise NotImplementedError(type(request).__name__)
+        return self._run(call())
+
+    def _make_dialog_filters(self):
+        filters = []
+        for i in range(self._folders):
+            peers = [utils.get_input_peer(chat.entity) for chat in self.chats[i::self._folders + 1]]
+            filters.append(types.DialogFilter(id=i + 2, title='Folder {}'.format(i), pinned_peers=[],
+                                              include_peers=peers[:len(peers) // 2], exclude_peers=peers[len(peers) // 2:],
+                                              contacts=i % 2 == 0, groups=i % 3 == 0, broadcasts=i % 2 == 1))
+        return filters
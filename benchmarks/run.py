@@ -0,0 +1,192 @@
+from telegram_datamanager.importer import Importer
+from telegram_datamanager.folders import Folders
+from telegram_datamanager.db import DataBase
+from telegram_datamanager.cassette import ReplayClient
+from telegram_datamanager.ratelimit import RateLimiter
+from .fake_client import FakeClient
+from datetime import datetime, timezone
+import argparse
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+
+def _parse_options(options):
+    # key=value pairs, values are parsed as JSON when possible
+    result = {}
+    for option in options:
+        key, value = option.split('=', 1)
+        try:
+            result[key] = json.loads(value)
+        except ValueError:
+            result[key] = value
+    return result
+
+
+def _parse_flood_waits(flood_waits):
+    # rpc=rate:seconds
+    result = {}
+    for flood_wait in flood_waits:
+        name, value = flood_wait.split('=', 1)
+        rate, seconds = value.split(':', 1)
+        result[name] = (int(rate), int(seconds))
+    return result
+
+
+def _make_client(args):
+    return FakeClient(chats=args.chats, messages=args.messages, media_ratio=args.media_ratio,
+                      document_ratio=args.document_ratio, media_size=args.media_size,
+                      duplicate_ratio=args.duplicate_ratio, latency=args.latency, folders=args.folders,
+                      flood_waits=_parse_flood_waits(args.flood_wait))
+
+
+def _make_rate_limiter(args):
+    return RateLimiter({name: float(rate) for name, rate in (rate.split('=', 1) for rate in args.rate)})
+
+
+def bench_db(args, folder):
+    result = {}
+    date = datetime(2020, 1, 1, tzinfo=timezone.utc)
+    rows = args.chats * args.messages
+
+    # One commit per message, like update_chats without batching
+    db = DataBase(os.path.join(folder, 'single.db'))
+    db.chat_add(1, 'bench', 'user')
+    start = time.monotonic()
+    for i in range(1, rows + 1):
+        db.message_add(1, i, 'message', date, 'text')
+        db.chat_update_max_id(1, i)
+        db.commit()
+    result['db_single_seconds'] = time.monotonic() - start
+    db.close()
+
+    db = DataBase(os.path.join(folder, 'batch.db'), commit_rows=1000)
+    db.chat_add(1, 'bench', 'user')
+    db.commit()
+    start = time.monotonic()
+    for i in range(1, rows + 1):
+        db.message_add_batch(1, i, 'message', date, 'text')
+        db.chat_update_max_id_batch(1, i)
+        db.commit_if_due()
+    db.flush()
+    result['db_batch_seconds'] = time.monotonic() - start
+    db.close()
+
+    result['db_rows'] = rows
+    return result
+
+
+def bench_folders(args, folder):
+    client = _make_client(args)
+    folders = Folders(client, rate_limiter=_make_rate_limiter(args))
+    start = time.monotonic()
+    folders.update()
+    return {'folders_seconds': time.monotonic() - start, 'folders_rpc': dict(client.calls)}
+
+
+def bench_sync(args, folder):
+    client = _make_client(args)
+    datastore_folder = os.path.join(folder, 'datastore')
+    work_folder = os.path.join(folder, 'work')
+    DataBase(os.path.join(datastore_folder, 'telegram_datamanager.db')).close()
+
+    start = time.monotonic()
+    with Importer(client, datastore_folder, work_folder, rate_limiter=_make_rate_limiter(args), **_parse_options(args.option)) as im:
+        im.update_chats()
+    elapsed = time.monotonic() - start
+
+    messages = sum(chat.messages for chat in client.chats)
+    return {'sync_seconds': elapsed,
+            'sync_messages_per_second': messages / elapsed if elapsed else 0,
+            'sync_rpc': dict(client.calls),
+            'sync_flood_waits': dict(client.flood_waits),
+            'sync_metrics': im.metrics.summary()}
+
+
+def bench_replay(args, folder):
+    # Sync against responses recorded from a real account with record_cassette
+    client = ReplayClient(args.cassette, time_scale=args.time_scale)
+    datastore_folder = os.path.join(folder, 'datastore')
+    work_folder = os.path.join(folder, 'work')
+    DataBase(os.path.join(datastore_folder, 'telegram_datamanager.db')).close()
+
+    start = time.monotonic()
+    with Importer(client, datastore_folder, work_folder, **_parse_options(args.option)) as im:
+        im.update_chats(allow_list=client.chat_ids())
+    elapsed = time.monotonic() - start
+
+    return {'replay_seconds': elapsed,
+            'replay_metrics': im.metrics.summary()}
+
+
+_benchmarks = {'db': bench_db, 'folders': bench_folders, 'sync': bench_sync, 'replay': bench_replay}
+
+
+def compare(result, baseline, tolerance):
+    # Names of *_seconds results slower than baseline by more than tolerance
+    regressions = []
+    for key, seconds in result.items():
+        if not key.endswith('_seconds') or key not in baseline:
+            continue
+        if seconds > baseline[key] * (1 + tolerance):
+            regressions.append('{}: {:.3f}s, baseline {:.3f}s'.format(key, seconds, baseline[key]))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark Telegram-DataManager against a fake Telegram client')
+    parser.add_argument('benchmarks', nargs='*', help='any of {}, default: all'.format(', '.join(sorted(_benchmarks))))
+    parser.add_argument('--chats', type=int, default=10)
+    parser.add_argument('--messages', type=int, default=1000, help='messages per chat')
+    parser.add_argument('--media-ratio', type=float, default=0.2)
+    parser.add_argument('--document-ratio', type=float, default=0.5)
+    parser.add_argument('--media-size', type=int, default=64 * 1024)
+    parser.add_argument('--duplicate-ratio', type=float, default=0.0)
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds per RPC')
+    parser.add_argument('--folders', type=int, default=3)
+    parser.add_argument('--flood-wait', action='append', default=[], help='flood wait of seconds when an RPC is called more than rate times a second, as rpc=rate:seconds, can repeat')
+    parser.add_argument('--rate', action='append', default=[], help='requests per second of an RPC class as class=rate, can repeat')
+    parser.add_argument('--cassette', help='responses recorded with record_cassette, for the replay benchmark')
+    parser.add_argument('--time-scale', type=float, default=1.0, help='multiplier of recorded response times in replay')
+    parser.add_argument('--option', action='append', default=[], help='Importer option as key=value, can repeat')
+    parser.add_argument('--output', help='write results as JSON')
+    parser.add_argument('--baseline', help='results JSON to compare with')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='allowed slowdown against baseline')
+    args = parser.parse_args(argv)
+    for name in args.benchmarks:
+        if name not in _benchmarks:
+            parser.error('unknown benchmark {}'.format(name))
+    if 'replay' in args.benchmarks and not args.cassette:
+        parser.error('replay needs --cassette')
+
+    result = {}
+    # replay only runs when asked for since it needs a cassette
+    for name in args.benchmarks or sorted(set(_benchmarks) - {'replay'}):
+        folder = tempfile.mkdtemp(prefix='tdm-bench-')
+        try:
+            result.update(_benchmarks[name](args, folder))
+        finally:
+            shutil.rmtree(folder)
+
+    print(json.dumps(result, indent=2))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(result, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = compare(result, baseline, args.tolerance)
+        for regression in regressions:
+            print('Regression {}'.format(regression), file=sys.stderr)
+        if regressions:
+            return 1
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,290 @@
+from telethon import types, utils
+from telethon.sessions import StringSession
+from .fileoperation import atomic_open
+from .tlutil import encode as _encode, decode as _decode, make_dialog, TotalList, OfflineClient
+import asyncio
+import json
+import os
+import time
+
+
+# Cassettes hold the Telethon responses Importer and Folders use, one JSON object per line:
+# {"method": , "key": , "seconds": , "result": }
+# Iterators also have "complete", false when the caller stopped before the end
+# TL objects are stored as base64 of their bytes, downloads only as file name and size
+
+def _peer_key(entity):
+    if isinstance(entity, int):
+        return entity
+    if isinstance(entity, str):
+        return entity
+    return utils.get_peer_id(entity)
+
+
+def _media_key(target):
+    media = getattr(target, 'media', target)
+    if isinstance(media, types.MessageMediaPhoto):
+        media = media.photo
+    elif isinstance(media, types.MessageMediaDocument):
+        media = media.document
+    elif isinstance(media, types.MessageMediaWebPage) and isinstance(media.webpage, types.WebPage):
+        media = media.webpage.document or media.webpage.photo
+    if isinstance(media, (types.Photo, types.Document)):
+        return '{}_{}'.format(type(media).__name__, media.id)
+    return None
+
+
+class _RecordingIter:
+    def __init__(self, recorder, method, key, iterator, encode):
+        self._recorder = recorder
+        self._method = method
+        self._key = key
+        self._iterator = iterator
+        self._encode = encode
+
+    def __iter__(self):
+        # (seconds waited, encoded item) of each item, added as they come
+        # A caller that stops early, like a dialog refresh, still leaves the items it used
+        entry = self._recorder._record(self._method, self._key, 0, [], complete=False)
+        iterator = iter(self._iterator)
+        while True:
+            start = time.monotonic()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                break
+            entry['result'].append((time.monotonic() - start, self._encode(item)))
+            yield item
+        entry['complete'] = True
+
+    async def __aiter__(self):
+        entry = self._recorder._record(self._method, self._key, 0, [], complete=False)
+        iterator = self._iterator.__aiter__()
+        while True:
+            start = time.monotonic()
+            try:
+                item = await iterator.__anext__()
+            except StopAsyncIteration:
+                break
+            entry['result'].append((time.monotonic() - start, self._encode(item)))
+            yield item
+        entry['complete'] = True
+
+
+class RecordingClient:
+    # Wraps a connected TelegramClient and records the responses Importer and Folders use
+    # Everything else is passed to the wrapped client
+    def __init__(self, client, path):
+        self._client = client
+        self._path = path
+        self._entries = []
+
+    def __getattr__(self, name):
+        return getattr(self._client, name)
+
+    def _record(self, method, key, seconds, result, **extra):
+        entry = dict({'method': method, 'key': key, 'seconds': seconds, 'result': result}, **extra)
+        self._entries.append(entry)
+        return entry
+
+    def _call(self, method, key, encode, func, *args, **kwargs):
+        # Works for both the sync and the coroutine form of telethon.sync methods
+        start = time.monotonic()
+        result = func(*args, **kwargs)
+        if asyncio.iscoroutine(result):
+            async def wait():
+                value = await result
+                self._record(method, key, time.monotonic() - start, encode(value))
+                return value
+            return wait()
+        self._record(method, key, time.monotonic() - start, encode(result))
+        return result
+
+    def save(self):
+        with atomic_open(self._path) as f:
+            for entry in self._entries:
+                f.write(json.dumps(entry))
+                f.write('\n')
+
+    def _encode_dialog(self, dialog):
+        return [_encode(dialog.dialog), _encode(dialog.entity), _encode(dialog.message)]
+
+    def _encode_download(self, path):
+        if not isinstance(path, str):
+            return None
+        return [os.path.basename(path), os.path.getsize(path)]
+
+    def get_me(self, *args, **kwargs):
+        return self._call('get_me', None, _encode, self._client.get_me, *args, **kwargs)
+
+    def get_dialogs(self, *args, **kwargs):
+        return self._call('get_dialogs', None, lambda r: [self._encode_dialog(d) for d in r],
+                          self._client.get_dialogs, *args, **kwargs)
+
+    def iter_dialogs(self, *args, **kwargs):
+        return _RecordingIter(self, 'iter_dialogs', None, self._client.iter_dialogs(*args, **kwargs), self._encode_dialog)
+
+    def iter_messages(self, entity, *args, **kwargs):
+        key = [_peer_key(entity), kwargs.get('min_id', 0), bool(kwargs.get('reverse'))]
+        return _RecordingIter(self, 'iter_messages', key, self._client.iter_messages(entity, *args, **kwargs), _encode)
+
+    def get_messages(self, entity, *args, **kwargs):
+        key = [_peer_key(entity), kwargs.get('min_id', 0), kwargs.get('limit')]
+        return self._call('get_messages', key, lambda r: {'total': getattr(r, 'total', len(r)), 'messages': _encode(list(r))},
+                          self._client.get_messages, entity, *args, **kwargs)
+
+    def get_entity(self, entity):
+        return self._call('get_entity', _peer_key(entity), _encode, self._client.get_entity, entity)
+
+    def download_media(self, message, *args, **kwargs):
+        return self._call('download_media', _media_key(message), self._encode_download,
+                          self._client.download_media, message, *args, **kwargs)
+
+    def iter_download(self, file, *args, **kwargs):
+        return _RecordingIter(self, 'iter_download', _media_key(file), self._client.iter_download(file, *args, **kwargs), len)
+
+    def __call__(self, request, *args, **kwargs):
+        return self._call(type(request).__name__, None, _encode, self._client, request, *args, **kwargs)
+
+
+class _ReplayIter:
+    def __init__(self, client, items, decode):
+        self._client = client
+        self._items = items
+        self._decode = decode
+
+    def __iter__(self):
+        for seconds, item in self._items:
+            self._client._run(self._client._wait(seconds))
+            yield self._decode(item)
+
+    async def __aiter__(self):
+        for seconds, item in self._items:
+            await self._client._wait(seconds)
+            yield self._decode(item)
+
+
+class ReplayClient(OfflineClient):
+    # Serves a cassette offline with the recorded timings multiplied by time_scale
+    def __init__(self, path, time_scale=1.0):
+        super().__init__(StringSession(), 1, 'replay')
+        self._time_scale = time_scale
+        self._pending_wait = 0
+
+        # (method, key) -> entries in recorded order
+        self._entries = {}
+        with open(path) as f:
+            for line in f:
+                entry = json.loads(line)
+                key = json.dumps(entry['key'])
+                self._entries.setdefault((entry['method'], key), []).append(entry)
+
+        # method, key -> times served
+        self.calls = {}
+
+    async def _wait(self, seconds):
+        # Waits shorter than the event loop resolution add up until they are worth a sleep
+        self._pending_wait += seconds * self._time_scale
+        if self._pending_wait < 0.002:
+            return
+        start = time.monotonic()
+        await asyncio.sleep(self._pending_wait)
+        self._pending_wait -= time.monotonic() - start
+
+    def _find(self, method, key=None):
+        entries = self._entries.get((method, json.dumps(key)))
+        if not entries:
+            raise KeyError('{} {} is not in cassette'.format(method, key))
+        # Serve repeated calls in recorded order, the last one again when they run out
+        count = self.calls.get((method, json.dumps(key)), 0)
+        self.calls[(method, json.dumps(key))] = count + 1
+        return entries[min(count, len(entries) - 1)]
+
+    def _replay(self, method, key, decode):
+        async def replay():
+            entry = self._find(method, key)
+            await self._wait(entry['seconds'])
+            return decode(entry['result'])
+        return self._run(replay())
+
+    def _decode_message(self, data):
+        message = _decode(data)
+        message._finish_init(self, {}, None)
+        return message
+
+    def _decode_dialog(self, data):
+        return make_dialog(self, *_decode(data))
+
+    def chat_ids(self):
+        # Chats whose history was recorded, as allow_list for Importer
+        return sorted({key[0] for method, k in self._entries for key in [json.loads(k)]
+                       if method in ('iter_messages', 'get_messages')})
+
+    def get_me(self, *args, **kwargs):
+        return self._replay('get_me', None, _decode)
+
+    def get_dialogs(self, *args, **kwargs):
+        if ('get_dialogs', 'null') not in self._entries:
+            # Only an iteration over all dialogs can stand in for get_dialogs, a refresh that stopped early lists a few
+            complete = [entry for entry in self._entries.get(('iter_dialogs', 'null'), []) if entry.get('complete', True)]
+            if not complete:
+                raise KeyError('get_dialogs is not in cassette, record against an empty datastore so all dialogs are listed')
+
+            async def get_dialogs():
+                items = complete[0]['result']
+                await self._wait(sum(seconds for seconds, item in items))
+                return [self._decode_dialog(item) for seconds, item in items]
+            return self._run(get_dialogs())
+        return self._replay('get_dialogs', None, lambda r: [self._decode_dialog(d) for d in r])
+
+    def iter_dialogs(self, *args, **kwargs):
+        if ('iter_dialogs', 'null') not in self._entries:
+            entry = self._find('get_dialogs')
+            items = [(entry['seconds'] if i == 0 else 0, d) for i, d in enumerate(entry['result'])]
+            return _ReplayIter(self, items, self._decode_dialog)
+        return _ReplayIter(self, self._find('iter_dialogs')['result'], self._decode_dialog)
+
+    def iter_messages(self, entity, *args, **kwargs):
+        min_id = kwargs.get('min_id', 0)
+        key = [_peer_key(entity), min_id, bool(kwargs.get('reverse'))]
+        try:
+            items = self._find('iter_messages', key)['result']
+        except KeyError:
+            # Run started from another max_message_id, use any recording of the chat
+            entries = [e for (method, k), es in self._entries.items() for e in es
+                       if method == 'iter_messages' and e['key'][0] == key[0]]
+            if not entries:
+                raise
+            items = [item for item in entries[0]['result'] if self._decode_message(item[1]).id > min_id]
+        return _ReplayIter(self, items, self._decode_message)
+
+    def get_messages(self, entity, *args, **kwargs):
+        def decode(result):
+            messages = TotalList(self._decode_message(m) for m in result['messages'])
+            messages.total = result['total']
+            return messages
+        return self._replay('get_messages', [_peer_key(entity), kwargs.get('min_id', 0), kwargs.get('limit')], decode)
+
+    def get_entity(self, entity):
+        return self._replay('get_entity', _peer_key(entity), _decode)
+
+    def download_media(self, message, file=None, progress_callback=None, **kwargs):
+        def decode(result):
+            if result is None:
+                return None
+            # Same name and size as recorded, content is not kept in cassettes
+            name, size = result
+            path = os.path.join(file, name)
+            with open(path, 'wb') as f:
+                f.truncate(size)
+            if progress_callback:
+                progress_callback(size, size)
+            return path
+        return self._replay('download_media', _media_key(message), decode)
+
+    def iter_download(self, file, *args, **kwargs):
+        items = self._find('iter_download', _media_key(file))['result']
+        return _ReplayIter(self, items, lambda size: bytes(size))
+
+    def __call__(self, request, *args, **kwargs):
+        return self._replay(type(request).__name__, None, _decode)
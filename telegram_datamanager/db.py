@@ -1,6 +1,10 @@
+from .fileoperation import atomic_path
+import contextlib
 import sqlite3
 import os
-from datetime import datetime
+import time
+from datetime import datetime, timezone
+from urllib.request import pathname2url
 
 
 class DataBase:
@@ -26,10 +30,7 @@ class DataBase:
                 username text
             )''')
 
-            c.execute(''' create table ProfilePhoto (
-                date text,
-                photo text
-            )''')
+            c.execute(self._profile_photo_table_sql('ProfilePhoto', 'text'))
 
             c.execute(''' create table Contact (
                 user_id integer,
@@ -47,51 +48,385 @@ class DataBase:
                 media_count integer
             )''')
 
-            c.execute(''' create table Message (
+            c.execute(self._message_table_sql('Message', 'text'))
+
+            c.execute(''' create table Media (
+                chat_id integer,
+                media_id integer,
+                file text,
+                next_id,
+                primary key (media_id, chat_id)
+            )''')
+
+            # Init fields
+            c.execute('insert into General values (?)', ('V1.0.0', ))
+
+            conn.commit()
+
+    def _profile_photo_table_sql(self, name, date_type):
+        return ''' create table {} (
+                date {},
+                photo text
+            )'''.format(name, date_type)
+
+    def _message_table_sql(self, name, date_type):
+        return ''' create table {0} (
                 message_id integer,
                 chat_id integer,
                 grouped_id integer,
                 type text,
-                date text,
+                date {1},
                 text text,
 
-                edited text,
+                edited {1},
                 sender_id text,
                 reply_to_message_id integer,
                 fwd_from integer,
                 media_id integer,
                 primary key (message_id, chat_id)
+            )'''.format(name, date_type)
+
+    def _version(self):
+        return self._conn.execute('SELECT version from General').fetchone()[0]
+
+    def _version_tuple(self, version):
+        return tuple(int(x) for x in version.lstrip('V').split('.'))
+
+    def _migrate(self):
+        # Apply all migrations newer than the version in General, in order
+        # sqlite3 commits DDL outside of a transaction, so each migration runs in an explicit one with its version
+        # Steps are also idempotent, for datastores a crash left half migrated before that
+        for version, migration in self._migrations:
+            if self._version_tuple(version) <= self._version_tuple(self._version()):
+                continue
+            self._conn.execute('BEGIN')
+            try:
+                migration(self)
+                self._conn.execute('UPDATE General SET version=?', (version,))
+            except BaseException:
+                self._conn.rollback()
+                raise
+            self._conn.commit()
+
+    def _migrate_message_indexes(self):
+        self._conn.execute('CREATE INDEX IF NOT EXISTS message_chat_date on Message (chat_id, date)')
+        self._conn.execute('CREATE INDEX IF NOT EXISTS message_sender on Message (sender_id)')
+        self._conn.execute('CREATE INDEX IF NOT EXISTS message_chat_grouped on Message (chat_id, grouped_id)')
+        self._conn.execute('CREATE INDEX IF NOT EXISTS message_chat_reply on Message (chat_id, reply_to_message_id)')
+
+    def _migrate_wal(self):
+        # journal_mode can't change inside a transaction, and it is kept in the db file
+        # Switching again after a crash does no harm, so it is committed before its version
+        self._conn.commit()
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('BEGIN')
+
+    def _migrate_date_format(self):
+        # 'text' for '%Y-%m-%d %H:%M:%S' strings, 'epoch' for integer seconds in UTC
+        columns = [row[1] for row in self._conn.execute('PRAGMA table_info(General)')]
+        if 'date_format' not in columns:
+            self._conn.execute("ALTER TABLE General ADD COLUMN date_format text DEFAULT 'text'")
+
+    def _migrate_media_store(self):
+        # One row per telegram photo/document, path is the first saved copy
+        self._conn.execute(''' create table IF NOT EXISTS MediaStore (
+                kind text,
+                telegram_id integer,
+                hash text,
+                path text,
+                name text,
+                primary key (kind, telegram_id)
             )''')
+        self._conn.execute('CREATE INDEX IF NOT EXISTS media_store_hash on MediaStore (hash)')
 
-            c.execute(''' create table Media (
+    def _migrate_entity_name(self):
+        # Names of users and chats, updated and used are unix seconds
+        self._conn.execute(''' create table IF NOT EXISTS EntityName (
+                peer_id integer primary key,
+                name text,
+                updated integer,
+                used integer
+            )''')
+        self._conn.execute('CREATE INDEX IF NOT EXISTS entity_name_used on EntityName (used)')
+
+    def _migrate_message_media(self):
+        # Attachments of a message in download order, filled from the Media.next_id chains
+        self._conn.execute(''' create table IF NOT EXISTS MessageMedia (
                 chat_id integer,
+                message_id integer,
+                ordinal integer,
                 media_id integer,
-                file text,
-                next_id,
-                primary key (media_id, chat_id)
+                primary key (chat_id, message_id, ordinal)
             )''')
+        self._conn.execute('CREATE INDEX IF NOT EXISTS message_media_media on MessageMedia (chat_id, media_id)')
+        self._conn.execute('''INSERT OR IGNORE into MessageMedia
+            WITH RECURSIVE chain(chat_id, message_id, ordinal, media_id) AS (
+                SELECT chat_id, message_id, 0, media_id from Message WHERE media_id IS NOT NULL
+                UNION ALL
+                SELECT chain.chat_id, chain.message_id, chain.ordinal + 1, Media.next_id from chain
+                JOIN Media ON Media.chat_id=chain.chat_id AND Media.media_id=chain.media_id
+                WHERE Media.next_id IS NOT NULL
+            ) SELECT chat_id, message_id, ordinal, media_id from chain''')
+
+    def _migrate_message_chat_id(self):
+        # Primary key is (message_id, chat_id), pages of one chat need chat_id first
+        self._conn.execute('CREATE INDEX IF NOT EXISTS message_chat_id on Message (chat_id, message_id)')
+
+    def _fts5_available(self):
+        try:
+            self._conn.execute('CREATE VIRTUAL TABLE temp.fts5_probe USING fts5(text)')
+        except sqlite3.OperationalError:
+            return False
+        self._conn.execute('DROP TABLE temp.fts5_probe')
+        return True
+
+    def _migrate_message_fts(self):
+        # Full text index over Message.text, rowids are the Message rowids
+        if not self._fts5_available():
+            # SQLite built without FTS5, search is not available
+            return
+        # Index of a build interrupted before its version was written, maybe empty
+        self._conn.execute('DROP TABLE IF EXISTS MessageFts')
+        self._conn.execute('''CREATE VIRTUAL TABLE MessageFts USING fts5(
+            text, content='Message', content_rowid='rowid', tokenize='unicode61 remove_diacritics 2')''')
+        self._conn.execute("INSERT into MessageFts (MessageFts) VALUES('rebuild')")
+
+    # (version, migration), in order
+    _migrations = (
+        ('V1.1.0', _migrate_message_indexes),
+        ('V1.2.0', _migrate_wal),
+        ('V1.3.0', _migrate_date_format),
+        ('V1.4.0', _migrate_media_store),
+        ('V1.5.0', _migrate_entity_name),
+        ('V1.6.0', _migrate_message_media),
+        ('V1.7.0', _migrate_message_chat_id),
+        ('V1.8.0', _migrate_message_fts),
+    )
+
+    def _convert_table_dates(self, table, create_sql, columns, date_columns, chunk_rows):
+        # Copy rows to a new table with integer dates, chunk by chunk
+        # Copied rows keep their rowid so an interrupted conversion continues where it stopped
+        new_table = '{}_epoch'.format(table)
+        if not self._conn.execute("SELECT name from sqlite_master WHERE type='table' AND name=?", (new_table,)).fetchone():
+            self._conn.execute(create_sql)
+
+        exprs = ["CAST(strftime('%s', {0}) AS INTEGER)".format(c) if c in date_columns else c for c in columns]
+        insert_sql = 'INSERT into {0} (rowid, {1}) SELECT rowid, {2} from {3} WHERE rowid > ? ORDER BY rowid LIMIT ?'.format(
+            new_table, ', '.join(columns), ', '.join(exprs), table)
+
+        while True:
+            last_rowid = self._conn.execute('SELECT max(rowid) from {}'.format(new_table)).fetchone()[0] or 0
+            with self._conn:
+                copied = self._conn.execute(insert_sql, (last_rowid, chunk_rows)).rowcount
+            if copied == 0:
+                break
+
+        return new_table
+
+    def _date_conversion_started(self):
+        return self._conn.execute("SELECT name from sqlite_master WHERE type='table' AND name='Message_epoch'").fetchone() is not None
+
+    def convert_dates_to_epoch(self, chunk_rows=100000):
+        # Runs when the db is opened, before anything else writes it
+        # An interrupted conversion is finished by the next writable open, with or without epoch_dates,
+        # so rows already copied can't change in between
+        if self._date_format == 'epoch':
+            # Indexes of datastores converted before they were created in the swap
+            with self._conn:
+                self._migrate_message_indexes()
+                self._migrate_message_chat_id()
+            return
 
-            # Init fields
-            c.execute('insert into General values (?)', ('V1.0.0', ))
-
-            conn.commit()
-
-    def __init__(self, filename):
-        # Create db if
-        if not os.path.exists(filename):
-            self._create(filename)
+        message_columns = ('message_id', 'chat_id', 'grouped_id', 'type', 'date', 'text',
+                           'edited', 'sender_id', 'reply_to_message_id', 'fwd_from', 'media_id')
+        new_message = self._convert_table_dates('Message', self._message_table_sql('Message_epoch', 'integer'),
+                                                message_columns, ('date', 'edited'), chunk_rows)
+        new_profile_photo = self._convert_table_dates('ProfilePhoto', self._profile_photo_table_sql('ProfilePhoto_epoch', 'integer'),
+                                                      ('date', 'photo'), ('date',), chunk_rows)
+
+        # Dropping Message drops its indexes, they are created again on the new table
+        index_sqls = [row[0] for row in self._conn.execute(
+            "SELECT sql from sqlite_master WHERE type='index' AND tbl_name='Message' AND sql IS NOT NULL")]
+
+        # Swap tables and create indexes in one transaction
+        with self._conn:
+            self._conn.execute("UPDATE General SET date_format='epoch'")
+            self._conn.execute('DROP TABLE Message')
+            self._conn.execute('ALTER TABLE {} RENAME TO Message'.format(new_message))
+            for index_sql in index_sqls:
+                self._conn.execute(index_sql)
+            self._conn.execute('DROP TABLE ProfilePhoto')
+            self._conn.execute('ALTER TABLE {} RENAME TO ProfilePhoto'.format(new_profile_photo))
+
+        self._date_format = 'epoch'
+
+    # commit_rows and commit_seconds enable the *_batch methods
+    # Pending rows are written and committed when either limit is reached
+    # wal switches the db to write-ahead logging so it can be written in place
+    # epoch_dates converts and stores dates as integer seconds in UTC
+    # metrics is a Metrics that commits are timed into
+    # read_only opens an existing db without writing, also while a sync writes to it
+    def __init__(self, filename, commit_rows=0, commit_seconds=0, wal=False, epoch_dates=False, metrics=None, read_only=False):
+        self._metrics = metrics
+        self._read_only = read_only
+
+        if read_only:
+            if not os.path.exists(filename):
+                raise FileNotFoundError('no db at {}'.format(filename))
+            self._conn = sqlite3.connect('file:{}?mode=ro'.format(pathname2url(os.path.abspath(filename))), uri=True)
+            if self._version_tuple(self._version()) < self._version_tuple(self._migrations[-1][0]):
+                raise ValueError('db is {}, open it once for writing to migrate'.format(self._version()))
+        else:
+            # Create db if
+            if not os.path.exists(filename):
+                self._create(filename)
+
+            # Importer's parallel sync uses the connection from its writer thread, one thread at a time
+            self._conn = sqlite3.connect(filename, check_same_thread=False)
+
+            # Bring old datastores to current schema
+            self._migrate()
+
+        self._date_format = self._conn.execute('SELECT date_format from General').fetchone()[0]
+        self._fts = self._conn.execute("SELECT name from sqlite_master WHERE type='table' AND name='MessageFts'").fetchone() is not None
+        if read_only:
+            return
 
-        self._conn = sqlite3.connect(filename)
+        if epoch_dates or self._date_conversion_started():
+            self.convert_dates_to_epoch()
+
+        if wal:
+            self._conn.execute('PRAGMA journal_mode=WAL')
+        # WAL is safe against corruption with NORMAL, only the last commits can be lost on power failure
+        if self._conn.execute('PRAGMA journal_mode').fetchone()[0] == 'wal':
+            self._conn.execute('PRAGMA synchronous=NORMAL')
+
+        # Batched writes
+        self._commit_rows = commit_rows
+        self._commit_seconds = commit_seconds
+        self._pending_messages = []
+        self._pending_media = []
+        self._pending_media_next = []
+        self._pending_max_id = {}
+        self._pending_media_count = {}
+        self._pending_message_media = []
+        self._last_commit = time.monotonic()
+        # Pending rows of messages that finished saving, see _mark_complete
+        self._mark_complete()
+
+        # chat_id -> media_count, allocated in memory
+        self._media_counts = {}
+
+    @staticmethod
+    def backup(filename, backup_filename, pages=1024):
+        # Copy of a db that may be in WAL mode, pages at a time so readers are not blocked for long
+        # Written next to backup_filename first so a crash never leaves half a backup
+        with atomic_path(backup_filename) as tmp_filename:
+            src = sqlite3.connect('file:{}?mode=ro'.format(pathname2url(os.path.abspath(filename))), uri=True)
+            dst = sqlite3.connect(tmp_filename)
+            try:
+                src.backup(dst, pages=pages)
+                # A single file, like the copied backup
+                dst.execute('PRAGMA journal_mode=DELETE')
+            finally:
+                dst.close()
+                src.close()
 
     def close(self):
+        if not self._read_only:
+            # Rows of a message interrupted while saving are dropped, its media ids are allocated again on resume
+            self._discard_incomplete()
+            self.flush()
         self._conn.close()
         return
 
-    def _date_to_str(self, date):
+    @property
+    def batched(self):
+        return bool(self._commit_rows or self._commit_seconds)
+
+    def _date_to_db(self, date):
+        if self._date_format == 'epoch':
+            # Naive datetimes are UTC, as text dates always were
+            if date.tzinfo is None:
+                date = date.replace(tzinfo=timezone.utc)
+            return int(date.timestamp())
+        # Text dates are UTC wall time, naive datetimes already are
+        if date.tzinfo is not None:
+            date = date.astimezone(timezone.utc)
         return date.strftime('%Y-%m-%d %H:%M:%S')
 
+    def date_from_db(self, value):
+        # '%Y-%m-%d %H:%M:%S' in UTC for both date formats
+        if self._date_format == 'epoch' and value is not None:
+            return datetime.fromtimestamp(value, timezone.utc).strftime('%Y-%m-%d %H:%M:%S')
+        return value
+
+    def _edited_to_db(self, edited):
+        if self._date_format == 'epoch' and edited is not None:
+            return self._date_to_db(edited)
+        return edited
+
+    def _phase(self, name):
+        if self._metrics:
+            return self._metrics.phase(name)
+        return contextlib.nullcontext()
+
     def commit(self):
-        self._conn.commit()
+        with self._phase('db_commit'):
+            self._conn.commit()
+        self._last_commit = time.monotonic()
+
+    # Batched writes
+    def pending_rows(self):
+        return len(self._pending_messages) + len(self._pending_media) + len(self._pending_media_next) + len(self._pending_message_media)
+
+    def flush(self):
+        # Write all pending rows and max_message_id in one transaction
+        if self.pending_rows() == 0 and not self._pending_max_id and not self._pending_media_count:
+            return
+
+        if self._metrics:
+            self._metrics.count('db_rows', self.pending_rows())
+        with self._phase('db_commit'), self._conn:
+            self._conn.executemany('INSERT OR IGNORE into Media VALUES(?,?,?,?)', self._pending_media)
+            self._conn.executemany('UPDATE Media SET next_id=? WHERE chat_id=? AND media_id=?', self._pending_media_next)
+            last_rowid = self._message_last_rowid()
+            self._conn.executemany('INSERT OR IGNORE into Message VALUES(?,?,?,?,?,?,?,?,?,?,?)', self._pending_messages)
+            self._message_index_after(last_rowid)
+            self._conn.executemany('INSERT OR REPLACE into MessageMedia VALUES(?,?,?,?)', self._pending_message_media)
+            self._conn.executemany('UPDATE Chat SET max_message_id=? WHERE chat_id=?',
+                                   [(max_message_id, chat_id) for chat_id, max_message_id in self._pending_max_id.items()])
+            self._conn.executemany('UPDATE Chat SET media_count=? WHERE chat_id=?',
+                                   [(media_count, chat_id) for chat_id, media_count in self._pending_media_count.items()])
+        self._last_commit = time.monotonic()
+
+        self._pending_messages = []
+        self._pending_media = []
+        self._pending_media_next = []
+        self._pending_max_id = {}
+        self._pending_media_count = {}
+        self._pending_message_media = []
+        self._mark_complete()
+
+    def _mark_complete(self):
+        # Rows queued so far belong to messages that finished saving
+        self._complete = (len(self._pending_messages), len(self._pending_media), len(self._pending_media_next),
+                          len(self._pending_message_media), dict(self._pending_max_id), dict(self._pending_media_count))
+
+    def _discard_incomplete(self):
+        messages, media, media_next, message_media, max_id, media_count = self._complete
+        del self._pending_messages[messages:]
+        del self._pending_media[media:]
+        del self._pending_media_next[media_next:]
+        del self._pending_message_media[message_media:]
+        self._pending_max_id = dict(max_id)
+        self._pending_media_count = dict(media_count)
+
+    def commit_if_due(self):
+        if self._commit_rows and self.pending_rows() >= self._commit_rows:
+            self.flush()
+        elif self._commit_seconds and time.monotonic() - self._last_commit >= self._commit_seconds:
+            self.flush()
 
     # Personal Info
     def check_and_update_personal_info(self, user_id, first, last, phone, username):
@@ -117,7 +452,7 @@ class DataBase:
     def append_profile_photo(self, date, photopath):
         c = self._conn.cursor()
 
-        datestr = self._date_to_str(date)
+        datestr = self._date_to_db(date)
         c.execute('INSERT into ProfilePhoto VALUES(?,?)', (datestr, photopath))
 
     # Contact
@@ -145,24 +480,53 @@ class DataBase:
         return self._conn.execute('SELECT max_message_id from Chat WHERE chat_id=?',
                                   (chat_id,)).fetchone()[0]
 
+    def chat_update_names(self, names):
+        # names: list of (chat_id, name)
+        self._conn.executemany('UPDATE Chat SET name=? WHERE chat_id=? AND name IS NOT ?',
+                               [(name, chat_id, name) for chat_id, name in names])
+
+    def chat_get_all(self):
+        return self._conn.execute('SELECT chat_id, name, type, max_message_id from Chat ORDER BY chat_id').fetchall()
+
+    def chat_get_all_max_id(self):
+        return dict(self._conn.execute('SELECT chat_id, max_message_id from Chat').fetchall())
+
     def chat_update_max_id(self, chat_id, max_message_id):
         if not self.chat_exist(chat_id):
             raise ValueError('chat_update_max_id: chat_id DNE')
 
         self._conn.execute('UPDATE Chat SET max_message_id=? WHERE chat_id=?', (max_message_id, chat_id))
 
+    def chat_update_max_id_batch(self, chat_id, max_message_id):
+        # Only written together with the rows before it, the last step of saving a message
+        self._pending_max_id[chat_id] = max_message_id
+        self._mark_complete()
+
     def chat_get_media_id(self, chat_id):
-        if not self.chat_exist(chat_id):
-            raise ValueError('chat_get_next_media_id: chat_id DNE')
+        # Counts are read once per chat, then allocated in memory
+        if chat_id not in self._media_counts:
+            row = self._conn.execute('SELECT media_count from Chat WHERE chat_id=?', (chat_id,)).fetchone()
+            if row is None:
+                raise ValueError('chat_get_next_media_id: chat_id DNE')
+            self._media_counts[chat_id] = row[0]
 
-        return self._conn.execute('SELECT media_count from Chat WHERE chat_id=?', (chat_id,)).fetchone()[0]
+        return self._media_counts[chat_id]
 
     def chat_get_next_media_id(self, chat_id):
         curr_count = self.chat_get_media_id(chat_id) + 1
+        self._media_counts[chat_id] = curr_count
         self._conn.execute('UPDATE Chat SET media_count = ? WHERE chat_id=?', (curr_count, chat_id))
 
         return curr_count
 
+    def chat_get_next_media_id_batch(self, chat_id):
+        # media_count is only written in the same transaction as the media rows
+        curr_count = self.chat_get_media_id(chat_id) + 1
+        self._media_counts[chat_id] = curr_count
+        self._pending_media_count[chat_id] = curr_count
+
+        return curr_count
+
     # Message
     def message_exist(self, chat_id, message_id):
         if self._conn.execute('SELECT * from Message WHERE chat_id=? AND message_id=?',
@@ -174,9 +538,119 @@ class DataBase:
         if self.message_exist(chat_id, message_id):
             raise ValueError('add duplicate message')
 
-        datestr = self._date_to_str(date)
-        self._conn.execute('INSERT into Message VALUES(?,?,?,?,?,?,?,?,?,?,?)',
-                           (message_id, chat_id, grouped_id, message_type, datestr, text, edited, sender_id, reply_to_message_id, fwd_from, media_id))
+        datestr = self._date_to_db(date)
+        rowid = self._conn.execute('INSERT into Message VALUES(?,?,?,?,?,?,?,?,?,?,?)',
+                                   (message_id, chat_id, grouped_id, message_type, datestr, text, self._edited_to_db(edited), sender_id, reply_to_message_id, fwd_from, media_id)).lastrowid
+        if self._fts:
+            self._conn.execute('INSERT into MessageFts (rowid, text) VALUES(?,?)', (rowid, text))
+
+    def message_add_batch(self, chat_id, message_id, message_type, date, text, grouped_id=0, edited=None, sender_id=None, reply_to_message_id=None, fwd_from=None, media_id=None):
+        datestr = self._date_to_db(date)
+        self._pending_messages.append((message_id, chat_id, grouped_id, message_type, datestr, text, self._edited_to_db(edited), sender_id, reply_to_message_id, fwd_from, media_id))
+
+    _message_columns = 'message_id, grouped_id, type, date, text, edited, sender_id, reply_to_message_id, fwd_from, media_id'
+
+    def message_to_dict(self, row):
+        # Row of _message_columns with dates as '%Y-%m-%d %H:%M:%S' UTC
+        message_id, grouped_id, message_type, date, text, edited, sender_id, reply_to_message_id, fwd_from, media_id = row
+        return {
+            'message_id': message_id,
+            'type': message_type,
+            'date': self.date_from_db(date),
+            'edited': self.date_from_db(edited),
+            'sender_id': sender_id,
+            'reply_to_message_id': reply_to_message_id,
+            'grouped_id': grouped_id,
+            'fwd_from': fwd_from,
+            'text': text
+        }
+
+    def message_get(self, chat_id, message_id):
+        return self._conn.execute('SELECT {} from Message WHERE chat_id=? AND message_id=?'.format(self._message_columns),
+                                  (chat_id, message_id)).fetchone()
+
+    def message_get_page(self, chat_id, after_message_id, limit):
+        # Messages after after_message_id in id order, for keyset pagination
+        return self._conn.execute('SELECT {} from Message WHERE chat_id=? AND message_id>? ORDER BY message_id LIMIT ?'.format(self._message_columns),
+                                  (chat_id, after_message_id, limit)).fetchall()
+
+    def message_get_date_page(self, chat_id, date_from, date_to, after, limit):
+        # Messages in [date_from, date_to) ordered by (date, message_id), after is the (date, message_id) of the previous page
+        sql = 'SELECT {} from Message WHERE chat_id=?'.format(self._message_columns)
+        params = [chat_id]
+        if date_from is not None:
+            sql += ' AND date>=?'
+            params.append(self._date_to_db(date_from))
+        if date_to is not None:
+            sql += ' AND date<?'
+            params.append(self._date_to_db(date_to))
+        if after is not None:
+            sql += ' AND (date, message_id)>(?, ?)'
+            params += list(after)
+        sql += ' ORDER BY date, message_id LIMIT ?'
+        params.append(limit)
+        return self._conn.execute(sql, params).fetchall()
+
+    def message_get_reply_chain(self, chat_id, message_id, limit):
+        # The message and the messages it replies to, up to the first one
+        return self._conn.execute('''WITH RECURSIVE chain(depth, message_id) AS (
+                SELECT 0, ?
+                UNION ALL
+                SELECT chain.depth + 1, Message.reply_to_message_id from chain
+                JOIN Message ON Message.chat_id=? AND Message.message_id=chain.message_id
+                WHERE Message.reply_to_message_id IS NOT NULL AND chain.depth < ?
+            ) SELECT {} from chain JOIN Message ON Message.chat_id=? AND Message.message_id=chain.message_id
+            ORDER BY chain.depth'''.format(', '.join('Message.' + c for c in self._message_columns.split(', '))),
+            (message_id, chat_id, limit - 1, chat_id)).fetchall()
+
+    def message_get_replies(self, chat_id, message_id, after_message_id, limit):
+        return self._conn.execute('''SELECT {} from Message WHERE chat_id=? AND reply_to_message_id=? AND message_id>?
+            ORDER BY message_id LIMIT ?'''.format(self._message_columns), (chat_id, message_id, after_message_id, limit)).fetchall()
+
+    def message_get_album(self, chat_id, grouped_id):
+        return self._conn.execute('SELECT {} from Message WHERE chat_id=? AND grouped_id=? ORDER BY message_id'.format(self._message_columns),
+                                  (chat_id, grouped_id)).fetchall()
+
+    # Search
+    def _message_last_rowid(self):
+        return self._conn.execute('SELECT max(rowid) from Message').fetchone()[0] or 0
+
+    def _message_index_after(self, rowid):
+        # Messages are only appended, new rows have rowids after the last one
+        if self._fts:
+            self._conn.execute('INSERT into MessageFts (rowid, text) SELECT rowid, text from Message WHERE rowid > ?', (rowid,))
+
+    def message_search_rebuild(self):
+        # Index all messages again, for datastores written without the index
+        with self._conn:
+            self._conn.execute("INSERT into MessageFts (MessageFts) VALUES('rebuild')")
+
+    def message_search(self, query, chat_id=None, date_from=None, date_to=None, limit=20, offset=0):
+        # [(chat_id, message_id, date, snippet)] best match first, query is FTS5 syntax
+        # date_from and date_to are datetimes, date_to is exclusive
+        if not self._fts:
+            raise ValueError('message_search: SQLite has no FTS5')
+
+        sql = '''SELECT m.chat_id, m.message_id, m.date, snippet(MessageFts, 0, '[', ']', '...', 16) from MessageFts
+            JOIN Message m ON m.rowid=MessageFts.rowid WHERE MessageFts MATCH ?'''
+        params = [query]
+        if chat_id is not None:
+            sql += ' AND m.chat_id=?'
+            params.append(chat_id)
+        if date_from is not None:
+            sql += ' AND m.date>=?'
+            params.append(self._date_to_db(date_from))
+        if date_to is not None:
+            sql += ' AND m.date<?'
+            params.append(self._date_to_db(date_to))
+        sql += ' ORDER BY rank LIMIT ? OFFSET ?'
+        params += [limit, offset]
+
+        return [(chat_id, message_id, self.date_from_db(date), snippet)
+                for chat_id, message_id, date, snippet in self._conn.execute(sql, params).fetchall()]
+
+    def message_count(self, chat_id):
+        return self._conn.execute('SELECT count(*) from Message WHERE chat_id=?', (chat_id,)).fetchone()[0]
 
     def message_update_media_id(self, chat_id, message_id, media_id):
         if not self.message_exist(chat_id, message_id):
@@ -201,3 +675,78 @@ class DataBase:
             raise ValueError('update nonexist media')
 
         self._conn.execute('UPDATE Media SET next_id=? WHERE chat_id=? AND media_id=?', (next_id, chat_id, media_id))
+
+    def media_add_batch(self, chat_id, media_id, filepath, next_id=None):
+        self._pending_media.append((chat_id, media_id, filepath, next_id))
+
+    def media_update_next_batch(self, chat_id, media_id, next_id):
+        self._pending_media_next.append((next_id, chat_id, media_id))
+
+    # Message media
+    def message_media_add(self, chat_id, message_id, ordinal, media_id):
+        self._conn.execute('INSERT OR REPLACE into MessageMedia VALUES(?,?,?,?)', (chat_id, message_id, ordinal, media_id))
+
+    def message_media_add_batch(self, chat_id, message_id, ordinal, media_id):
+        self._pending_message_media.append((chat_id, message_id, ordinal, media_id))
+
+    def message_media_get(self, chat_id, message_id):
+        # [(media_id, file)] of one message in download order
+        return self._conn.execute('''SELECT mm.media_id, m.file from MessageMedia mm
+            LEFT JOIN Media m ON m.chat_id=mm.chat_id AND m.media_id=mm.media_id
+            WHERE mm.chat_id=? AND mm.message_id=? ORDER BY mm.ordinal''', (chat_id, message_id)).fetchall()
+
+    def message_media_get_range(self, chat_id, first_message_id, last_message_id):
+        # message_id -> [(media_id, file)] for a page of messages
+        result = {}
+        for message_id, media_id, path in self._conn.execute('''SELECT mm.message_id, mm.media_id, m.file from MessageMedia mm
+                LEFT JOIN Media m ON m.chat_id=mm.chat_id AND m.media_id=mm.media_id
+                WHERE mm.chat_id=? AND mm.message_id BETWEEN ? AND ? ORDER BY mm.message_id, mm.ordinal''',
+                (chat_id, first_message_id, last_message_id)):
+            result.setdefault(message_id, []).append((media_id, path))
+        return result
+
+    def media_get_all_files(self):
+        return self._conn.execute('SELECT chat_id, media_id, file from Media WHERE file IS NOT NULL').fetchall()
+
+    def media_clear_files(self, media):
+        # media: list of (chat_id, media_id), kept like failed downloads
+        self._conn.executemany('UPDATE Media SET file=NULL WHERE chat_id=? AND media_id=?', media)
+
+    # Media store
+    def media_store_get(self, kind, telegram_id):
+        return self._conn.execute('SELECT path, name from MediaStore WHERE kind=? AND telegram_id=?', (kind, telegram_id)).fetchone()
+
+    def media_store_get_by_hash(self, file_hash):
+        return self._conn.execute('SELECT path, name from MediaStore WHERE hash=? LIMIT 1', (file_hash,)).fetchone()
+
+    def media_store_add(self, kind, telegram_id, file_hash, path, name):
+        self._conn.execute('INSERT OR IGNORE into MediaStore VALUES(?,?,?,?,?)', (kind, telegram_id, file_hash, path, name))
+
+    def media_store_get_all_paths(self):
+        return [row[0] for row in self._conn.execute('SELECT DISTINCT path from MediaStore').fetchall()]
+
+    def media_store_remove_paths(self, paths):
+        self._conn.executemany('DELETE from MediaStore WHERE path=?', [(path,) for path in paths])
+
+    # Entity name
+    def entity_name_get(self, peer_id):
+        return self._conn.execute('SELECT name, updated from EntityName WHERE peer_id=?', (peer_id,)).fetchone()
+
+    def entity_name_set_many(self, names, now):
+        # names: list of (peer_id, name)
+        self._conn.executemany('INSERT OR REPLACE into EntityName VALUES(?,?,?,?)',
+                               [(peer_id, name, now, now) for peer_id, name in names])
+
+    def entity_name_set_listed(self, names, now):
+        # names: list of (peer_id, name, updated), a stored name updated later is kept
+        self._conn.executemany('''INSERT into EntityName VALUES(?,?,?,?) ON CONFLICT(peer_id) DO UPDATE SET
+            name=excluded.name, updated=excluded.updated, used=excluded.used WHERE excluded.updated>=EntityName.updated''',
+                               [(peer_id, name, updated, now) for peer_id, name, updated in names])
+
+    def entity_name_touch(self, peer_id, now):
+        self._conn.execute('UPDATE EntityName SET used=? WHERE peer_id=?', (now, peer_id))
+
+    def entity_name_evict(self, max_entries):
+        # Remove least recently used names over max_entries
+        self._conn.execute('''DELETE from EntityName WHERE peer_id IN (
+            SELECT peer_id from EntityName ORDER BY used DESC LIMIT -1 OFFSET ?)''', (max_entries,))
@@ -0,0 +1,102 @@
+from .fileoperation import atomic_open
+from .ratelimit import RateLimiter
+from .tlutil import encode, decode, make_dialog
+import json
+import os
+import time
+
+
+class DialogCache:
+    # A refresh only lists dialogs with new messages since the snapshot
+    # Unread counts, mute and archive state and titles of the other dialogs can be stale, and deleted or left dialogs stay
+    # get_dialogs(full=True) and every full_every-th run list all dialogs, which replaces the snapshot
+    def __init__(self, client, path=None, rate_limiter=None, full_every=10):
+        self._client = client
+        self._rate_limiter = rate_limiter if rate_limiter else RateLimiter()
+        # Snapshot file, None keeps the cache in memory only
+        self._path = path
+        self._full_every = full_every
+        # dialog id -> Dialog
+        self._dialogs = None
+        # dialog id -> unix seconds the dialog was last listed from the server
+        self._listed = {}
+        # Refreshes since the last full listing, kept in the snapshot
+        self._refreshes = 0
+        # All dialogs were listed in this run
+        self._full = False
+
+    def _load(self):
+        if not self._path or not os.path.exists(self._path):
+            return None
+
+        with open(self._path) as f:
+            snapshot = json.load(f)
+        self._refreshes = snapshot.get('refreshes', 0)
+
+        dialogs = {}
+        self._listed = {}
+        for entry in snapshot['dialogs']:
+            d = make_dialog(self._client, *decode(entry[:3]))
+            dialogs[d.id] = d
+            # Snapshots written before listing times were kept count as old
+            self._listed[d.id] = entry[3] if len(entry) > 3 else 0
+        return dialogs
+
+    def _save(self):
+        if not self._path:
+            return
+
+        snapshot = {'refreshes': self._refreshes,
+                    'dialogs': [(encode(d.dialog), encode(d.entity), encode(d.message), self._listed.get(d.id, 0))
+                                for d in self._dialogs.values()]}
+        with atomic_open(self._path) as f:
+            json.dump(snapshot, f)
+
+    def _refresh_dialogs(self):
+        # Dialogs come pinned first, then newest message first
+        # Stop at the first unpinned dialog that is not newer than the snapshot
+        newest = max((d.date for d in self._dialogs.values() if d.date and not d.pinned), default=None)
+        now = int(time.time())
+        for dialog in self._client.iter_dialogs(ignore_migrated=True):
+            if newest and not dialog.pinned and dialog.date and dialog.date <= newest:
+                break
+            self._dialogs[dialog.id] = dialog
+            self._listed[dialog.id] = now
+
+    def _list_dialogs(self):
+        # Dialogs missing from the listing were deleted or left
+        dialogs = self._rate_limiter.call('dialogs', self._client.get_dialogs, limit=None, ignore_migrated=True)
+        self._dialogs = {d.id: d for d in dialogs}
+        now = int(time.time())
+        self._listed = {d.id: now for d in dialogs}
+        self._refreshes = 0
+        self._full = True
+        self._save()
+
+    def get_dialogs(self, full=False):
+        # full: state of every dialog is current, for callers that use more than ids and top messages
+        if self._dialogs is None and not full:
+            self._dialogs = self._load()
+            if self._dialogs is not None and self._refreshes + 1 >= self._full_every:
+                self._dialogs = None
+            elif self._dialogs is not None:
+                # Started again from the top after a flood wait
+                self._rate_limiter.call('dialogs', self._refresh_dialogs)
+                self._refreshes += 1
+                self._save()
+
+        if self._dialogs is None or (full and not self._full):
+            self._list_dialogs()
+
+        return list(self._dialogs.values())
+
+    def listed(self):
+        # dialog id -> unix seconds the dialog returned by get_dialogs was last listed from the server
+        return dict(self._listed)
+
+    def invalidate(self):
+        # Next get_dialogs does a full listing
+        self._dialogs = None
+        self._full = False
+        if self._path and os.path.exists(self._path):
+            os.remove(self._path)
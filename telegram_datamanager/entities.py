@@ -0,0 +1,51 @@
+from telethon import types
+from .ratelimit import RateLimiter
+import time
+
+
+class EntityCache:
+    def __init__(self, db, client, ttl=7 * 24 * 3600, max_entries=100000, rate_limiter=None):
+        self._db = db
+        self._client = client
+        self._rate_limiter = rate_limiter if rate_limiter else RateLimiter()
+        # Names older than ttl seconds are fetched again
+        self._ttl = ttl
+        # Least recently used names over max_entries are removed
+        self._max_entries = max_entries
+        # peer_id -> name, for this run
+        self._names = {}
+
+    def get_entity_name(self, entity):
+        if isinstance(entity, types.User):
+            return "{} {}".format(entity.first_name, entity.last_name)
+
+        return entity.title
+
+    def fill_from_dialogs(self, dialogs, listed=None):
+        # listed: dialog id -> unix seconds the dialog was listed from the server, e.g. DialogCache.listed()
+        # Names of cached dialogs keep their age, so the ttl still applies to them, None means listed now
+        now = int(time.time())
+        names = [(dialog.id, self.get_entity_name(dialog.entity), listed.get(dialog.id, 0) if listed is not None else now)
+                 for dialog in dialogs]
+        self._db.entity_name_set_listed(names, now)
+        self._db.entity_name_evict(self._max_entries)
+        self._db.commit()
+        self._names.update((peer_id, name) for peer_id, name, updated in names if now - updated < self._ttl)
+
+    def get_name(self, peer_id):
+        if peer_id in self._names:
+            return self._names[peer_id]
+
+        now = int(time.time())
+        stored = self._db.entity_name_get(peer_id)
+        if stored and now - stored[1] < self._ttl:
+            self._db.entity_name_touch(peer_id, now)
+            name = stored[0]
+        else:
+            name = self.get_entity_name(self._rate_limiter.call('entities', self._client.get_entity, peer_id))
+            self._db.entity_name_set_many([(peer_id, name)], now)
+            self._db.entity_name_evict(self._max_entries)
+        self._db.commit()
+
+        self._names[peer_id] = name
+        return name
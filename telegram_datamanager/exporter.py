@@ -0,0 +1,111 @@
+from .db import DataBase
+from .fileoperation import atomic_open
+import html
+import json
+import os
+
+
+class Exporter:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self._db.close()
+
+    # Writes messages.jsonl and messages.html of each chat to export_folder/<chat_id>
+    # Messages are read page_size at a time, so memory does not grow with the chat
+    def __init__(self, datastore_folder, export_folder, display_callback=None, page_size=1000):
+        self._datastore_folder = datastore_folder
+        self._export_folder = export_folder
+        self._raw_display_callback = display_callback
+        self._page_size = page_size
+
+        # chat_id -> max_message_id of the last export
+        self._state_path = os.path.join(self._export_folder, 'export_state.json')
+
+        # Read-only, an export never creates or migrates a datastore, and can run during an in-place sync
+        self._db = DataBase(os.path.join(self._datastore_folder, 'telegram_datamanager.db'), read_only=True)
+        os.makedirs(self._export_folder, mode=0o755, exist_ok=True)
+
+    def _display_callback(self, line0=None, line1=None, line2=None):
+        if self._raw_display_callback:
+            self._raw_display_callback(line0, line1, line2)
+
+    def _load_state(self):
+        if not os.path.exists(self._state_path):
+            return {}
+        with open(self._state_path) as f:
+            return {int(chat_id): max_message_id for chat_id, max_message_id in json.load(f).items()}
+
+    def _save_state(self, state):
+        with atomic_open(self._state_path) as f:
+            json.dump(state, f, indent=2)
+
+    def _iter_messages(self, chat_id):
+        # Keyset pagination on (chat_id, message_id), attachments of each page in one query
+        after_message_id = 0
+        while True:
+            page = self._db.message_get_page(chat_id, after_message_id, self._page_size)
+            if not page:
+                return
+            media = self._db.message_media_get_range(chat_id, page[0][0], page[-1][0])
+            for row in page:
+                message = self._db.message_to_dict(row)
+                message['media'] = [{'media_id': media_id, 'file': path} for media_id, path in media.get(message['message_id'], [])]
+                yield message
+            after_message_id = page[-1][0]
+
+    def _iter_jsonl(self, chat_id):
+        for message in self._iter_messages(chat_id):
+            yield json.dumps(message, ensure_ascii=False)
+            yield '\n'
+
+    def _iter_html(self, chat_id, chat_name, chat_folder):
+        yield '<!DOCTYPE html>\n<html>\n<head>\n<meta charset="utf-8">\n'
+        yield '<title>{}</title>\n</head>\n<body>\n<h1>{}</h1>\n'.format(html.escape(chat_name), html.escape(chat_name))
+        for message in self._iter_messages(chat_id):
+            yield '<div class="message" id="message{}">\n'.format(message['message_id'])
+            yield '<p class="meta">{} {}</p>\n'.format(html.escape(message['date'] or ''), html.escape(str(message['sender_id'] or '')))
+            if message['reply_to_message_id']:
+                yield '<p class="reply"><a href="#message{0}">reply to {0}</a></p>\n'.format(message['reply_to_message_id'])
+            if message['text']:
+                yield '<p class="text">{}</p>\n'.format(html.escape(message['text']).replace('\n', '<br>\n'))
+            for media in message['media']:
+                if media['file']:
+                    href = os.path.relpath(media['file'], start=chat_folder)
+                    yield '<p class="media"><a href="{}">{}</a></p>\n'.format(html.escape(href), html.escape(os.path.basename(media['file'])))
+            yield '</div>\n'
+        yield '</body>\n</html>\n'
+
+    def _write(self, path, chunks):
+        # Readers never see half a file
+        with atomic_open(path) as f:
+            f.writelines(chunks)
+
+    def export_chats(self, allow_list=None):
+        # Only chats whose max_message_id changed since the last export are written again
+        self._display_callback('Exporting Chats ...')
+        state = self._load_state()
+
+        chats = [chat for chat in self._db.chat_get_all()
+                 if not allow_list or chat[0] in allow_list or chat[1] in allow_list]
+        exported = 0
+        try:
+            for i, (chat_id, chat_name, chat_type, max_message_id) in enumerate(chats):
+                chat_folder = os.path.join(self._export_folder, str(chat_id))
+                if state.get(chat_id) == max_message_id and os.path.isdir(chat_folder):
+                    continue
+
+                self._display_callback(None, 'Exporting Chat {} {:,}/{:,}'.format(chat_name, i + 1, len(chats)))
+                os.makedirs(chat_folder, mode=0o755, exist_ok=True)
+                self._write(os.path.join(chat_folder, 'messages.jsonl'), self._iter_jsonl(chat_id))
+                self._write(os.path.join(chat_folder, 'messages.html'), self._iter_html(chat_id, chat_name or str(chat_id), chat_folder))
+
+                state[chat_id] = max_message_id
+                exported += 1
+        finally:
+            # Chats written so far are not exported again
+            self._save_state(state)
+
+        self._display_callback(None, 'Exported {:,} Chats, {:,} unchanged'.format(exported, len(chats) - exported))
+        return exported
@@ -0,0 +1,25 @@
+import contextlib
+import os
+
+
+@contextlib.contextmanager
+def atomic_path(path):
+    # Yields a path next to path to write to, moved over path when the block ends without an error
+    # Readers never see half a file, and a crash never leaves one
+    tmp_path = '{}.tmp'.format(path)
+    if os.path.exists(tmp_path):
+        os.remove(tmp_path)
+    try:
+        yield tmp_path
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    os.replace(tmp_path, path)
+
+
+@contextlib.contextmanager
+def atomic_open(path, mode='w'):
+    with atomic_path(path) as tmp_path:
+        with open(tmp_path, mode) as f:
+            yield f
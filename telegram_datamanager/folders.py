@@ -1,4 +1,5 @@
 from telethon import TelegramClient, sync, functions, types, utils
+from .ratelimit import RateLimiter
 from datetime import datetime
 
 
@@ -16,8 +17,11 @@ class Folder:
 
 
 class Folders:
-    def __init__(self, client):
+    def __init__(self, client, dialog_cache=None, entity_cache=None, rate_limiter=None):
         self._client = client
+        self._rate_limiter = rate_limiter if rate_limiter else RateLimiter()
+        self._dialog_cache = dialog_cache
+        self._entity_cache = entity_cache
         self.folders = list()
 
     def __str__(self):
@@ -26,9 +30,14 @@ class Folders:
             ret += "{}\n\n".format(f.__str__())
         return ret
 
+    def _get_dialogs(self, full=False):
+        if self._dialog_cache:
+            return self._dialog_cache.get_dialogs(full)
+        return self._rate_limiter.call('dialogs', self._client.get_dialogs, limit=None, ignore_migrated=True)
+
     def get_contact_list(self):
         contact_list = []
-        result = self._client(functions.contacts.GetContactsRequest(hash=0))
+        result = self._rate_limiter.call('entities', self._client, functions.contacts.GetContactsRequest(hash=0))
         for c in result.contacts:
             contact_list.append(c.user_id)
         return contact_list
@@ -62,19 +71,25 @@ class Folders:
     def match_dialog_w_input_peer(self, dialog, input_peer):
         return dialog['id'] == utils.get_peer_id(input_peer)
 
-    def match_dialog_w_filter(self, dialog_info, dialog_filter):
+    def get_filter_peer_ids(self, dialog_filter):
+        include_ids = set(utils.get_peer_id(input_peer) for input_peer in dialog_filter.include_peers)
+        exclude_ids = set(utils.get_peer_id(input_peer) for input_peer in dialog_filter.exclude_peers)
+        return include_ids, exclude_ids
+
+    def match_dialog_w_filter(self, dialog_info, dialog_filter, include_ids=None, exclude_ids=None):
         include = False
         exclude = False
 
+        if include_ids is None or exclude_ids is None:
+            include_ids, exclude_ids = self.get_filter_peer_ids(dialog_filter)
+
         # Check if is included manually
-        for input_peer in dialog_filter.include_peers:
-            if self.match_dialog_w_input_peer(dialog_info, input_peer):
-                return True
+        if dialog_info['id'] in include_ids:
+            return True
 
         # Check if is excluded manually
-        for input_peer in dialog_filter.exclude_peers:
-            if self.match_dialog_w_input_peer(dialog_info, input_peer):
-                return False
+        if dialog_info['id'] in exclude_ids:
+            return False
 
         # Check against rules
         if dialog_filter.contacts and dialog_info['is_contact'] and dialog_info['type'] == 'user':
@@ -99,18 +114,30 @@ class Folders:
         return include and not exclude
 
     def update(self):
-        all_dialogs = self._client.get_dialogs(limit=None, ignore_migrated=True)
-        all_contacts = self.get_contact_list()
-        all_dialog_filters = self._client(functions.messages.GetDialogFiltersRequest())
-
+        all_dialog_filters = self._rate_limiter.call('dialogs', self._client, functions.messages.GetDialogFiltersRequest())
+        # Read, muted and archived state of cached dialogs can be stale
+        full = any(getattr(f, 'exclude_read', False) or getattr(f, 'exclude_muted', False) or getattr(f, 'exclude_archived', False)
+                   for f in all_dialog_filters)
+        all_dialogs = self._get_dialogs(full)
+        if self._entity_cache:
+            self._entity_cache.fill_from_dialogs(all_dialogs, self._dialog_cache.listed() if self._dialog_cache else None)
+        all_contacts = set(self.get_contact_list())
+
+        # Peer ids of each filter, computed once
+        compiled = []
         for dialog_filter in all_dialog_filters:
             folder = Folder(dialog_filter.id, dialog_filter.title)
+            include_ids, exclude_ids = self.get_filter_peer_ids(dialog_filter)
+            compiled.append((folder, dialog_filter, include_ids, exclude_ids))
 
-            for dialog in all_dialogs:
-                info = self.generate_dialog_info(dialog, all_contacts)
-                if self.match_dialog_w_filter(info, dialog_filter):
+        # One pass over dialogs
+        for dialog in all_dialogs:
+            info = self.generate_dialog_info(dialog, all_contacts)
+            for folder, dialog_filter, include_ids, exclude_ids in compiled:
+                if self.match_dialog_w_filter(info, dialog_filter, include_ids, exclude_ids):
                     folder.append(dialog.id)
 
+        for folder, _, _, _ in compiled:
             self.folders.append(folder)
 
     def print_folders(self):
@@ -127,7 +154,7 @@ class Folders:
         if self.folders == []:
             self.update()
 
-        all_dialogs = self._client.get_dialogs(limit=None, ignore_migrated=True)
+        all_dialogs = self._get_dialogs()
 
         # Init map
         dialog_to_folder = {}
@@ -145,7 +172,10 @@ class Folders:
         return dialog_to_folder
 
     def get_name_from_id(self, id):
-        entity = self._client.get_entity(id)
+        if self._entity_cache:
+            return self._entity_cache.get_name(id)
+
+        entity = self._rate_limiter.call('entities', self._client.get_entity, id)
 
         if isinstance(entity, types.User):
             return "{} {}".format(entity.first_name, entity.last_name)
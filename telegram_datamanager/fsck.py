@@ -0,0 +1,105 @@
+from concurrent.futures import ThreadPoolExecutor
+import os
+import re
+import time
+
+
+class Fsck:
+    # Cross-checks media files on disk with the Media and MediaStore tables
+    # orphans: files named <media_id>@<name> in a chat folder that no row refers to
+    # missing: Media rows whose file is gone
+    # stale_partials: resumable downloads in partial_folder not written for partial_max_age seconds
+    def __init__(self, db, media_folder, workers=8, display_callback=None, partial_folder=None, partial_max_age=7 * 24 * 3600):
+        self._db = db
+        self._media_folder = media_folder
+        self._partial_folder = partial_folder
+        self._partial_max_age = partial_max_age
+        self._workers = workers
+        self._display_callback = display_callback if display_callback else lambda *args: None
+
+    def _key(self, path):
+        # Chat folder and file name, so datastores moved since the path was stored still match
+        return os.path.basename(os.path.dirname(path)), os.path.basename(path)
+
+    def _scan_folder(self, folder):
+        # Names of media files in one chat folder
+        names = set()
+        with os.scandir(os.path.join(self._media_folder, folder)) as it:
+            for entry in it:
+                if entry.is_file() and re.match(r'[0-9]+@', entry.name):
+                    names.add(entry.name)
+        return folder, names
+
+    def _scan_partials(self):
+        if not self._partial_folder or not os.path.isdir(self._partial_folder):
+            return []
+        expired = time.time() - self._partial_max_age
+        with os.scandir(self._partial_folder) as it:
+            return sorted(entry.path for entry in it if entry.is_file() and entry.stat().st_mtime < expired)
+
+    def _scan(self):
+        # chat folder name -> names of media files, folders are scanned in parallel
+        with os.scandir(self._media_folder) as it:
+            folders = [entry.name for entry in it if entry.is_dir() and re.fullmatch(r'-?[0-9]+', entry.name)]
+
+        files = {}
+        with ThreadPoolExecutor(max_workers=self._workers) as executor:
+            for i, (folder, names) in enumerate(executor.map(self._scan_folder, folders)):
+                if i % 100 == 0:
+                    self._display_callback(None, 'Scanned folder {}/{}'.format(i + 1, len(folders)))
+                files[folder] = names
+        return files
+
+    def check(self):
+        self._display_callback('Checking media files')
+        files = self._scan()
+        chat_ids = set(self._db.chat_get_all_max_id())
+
+        self._display_callback(None, 'Checking Media table')
+        referenced = set()
+        missing = []
+        for chat_id, media_id, path in self._db.media_get_all_files():
+            folder, name = self._key(path)
+            referenced.add((folder, name))
+            if folder in files:
+                exists = name in files[folder]
+            else:
+                # Outside the media folder, e.g. a dedup link that fell back to the source path
+                exists = os.path.isfile(path)
+            if not exists:
+                missing.append((chat_id, media_id, path))
+        for path in self._db.media_store_get_all_paths():
+            referenced.add(self._key(path))
+
+        # Only folders of known chats, anything else was not written by us
+        orphans = []
+        for folder, names in files.items():
+            if int(folder) not in chat_ids:
+                continue
+            for name in names:
+                if (folder, name) not in referenced:
+                    orphans.append(os.path.join(self._media_folder, folder, name))
+
+        orphans.sort()
+        return {'orphans': orphans, 'missing': missing, 'stale_partials': self._scan_partials()}
+
+    def apply(self, result):
+        # Remove orphans and stale partials, and clear missing files from the DB so they are not linked again
+        self._display_callback(None, 'Removing {} orphan files'.format(len(result['orphans'])))
+        with ThreadPoolExecutor(max_workers=self._workers) as executor:
+            list(executor.map(os.remove, result['orphans']))
+
+        self._display_callback(None, 'Removing {} stale partial downloads'.format(len(result['stale_partials'])))
+        for path in result['stale_partials']:
+            os.remove(path)
+
+        self._display_callback(None, 'Clearing {} missing files'.format(len(result['missing'])))
+        self._db.media_clear_files([(chat_id, media_id) for chat_id, media_id, path in result['missing']])
+        self._db.media_store_remove_paths([path for chat_id, media_id, path in result['missing']])
+        self._db.commit()
+
+    def run(self, apply=False):
+        result = self.check()
+        if apply:
+            self.apply(result)
+        return result
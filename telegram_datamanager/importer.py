@@ -1,5 +1,14 @@
-from telethon import TelegramClient, events, sync, types
+from telethon import TelegramClient, events, sync, types, utils
 from .db import DataBase
+from .entities import EntityCache
+from .fsck import Fsck
+from .metrics import Metrics, FloodWaitLogHandler
+from .ratelimit import RateLimiter
+from telethon.errors import FloodWaitError
+import asyncio
+import concurrent.futures
+import functools
+import hashlib
 import os
 import shutil
 import sys
@@ -13,11 +22,32 @@ class Importer:
         return self
 
     def __exit__(self, exc_type, exc_value, traceback):
-        self._close_db()
+        try:
+            self._close_db()
+            self._write_metrics()
+        finally:
+            self._flood_wait_log.uninstall()
 
-    def __init__(self, client, datastore_folder, work_folder, display_callback=None, download_progress_callback=None, display_progress=False, create_symlink=False, check_media_ids=False):
+    def __init__(self, client, datastore_folder, work_folder, display_callback=None, download_progress_callback=None, display_progress=False, create_symlink=False, check_media_ids=False, concurrent_downloads=1, parallel_chats=1, chat_progress_callback=None, single_pass=False, fast_new_content_check=False, commit_rows=0, commit_seconds=0, in_place_db=False, epoch_dates=False, dedup_media=False, resumable_downloads=False, stage_in_datastore=False, db_backup=False, dialog_cache=None, metrics_path=None, fsck_apply=False, fsck_workers=8, rate_limiter=None):
         # Set variables
         self._client = client
+        self._dialog_cache = dialog_cache
+
+        # Number of files downloaded at the same time, 1 means download one by one
+        if concurrent_downloads < 1:
+            raise ValueError('concurrent_downloads must be at least 1')
+        self._concurrent_downloads = concurrent_downloads
+
+        # Number of chats synced at the same time, 1 means chat by chat
+        if parallel_chats < 1:
+            raise ValueError('parallel_chats must be at least 1')
+        self._parallel_chats = parallel_chats
+
+        # Estimate new messages from server reported total instead of walking the history twice
+        self._single_pass = single_pass
+
+        # Compare top message id of dialogs with DB instead of asking the server for each chat
+        self._fast_new_content_check = fast_new_content_check
 
         # Data store folder
         self._datastore_folder = datastore_folder
@@ -27,28 +57,94 @@ class Importer:
         # Working folder
         self._work_folder = work_folder
         self._tmp_folder = os.path.join(self._work_folder, 'tmp')
-
-        # Make all dirs
-        self._makedirs()
-
-        self._db = self._open_db()
+        # Partial downloads, kept between runs
+        self._partial_folder = os.path.join(self._work_folder, 'partial')
+
+        # Download into datastore filesystem so saving media is a rename
+        self._stage_in_datastore = stage_in_datastore
+        self._staging_folder = os.path.join(self._datastore_folder, 'staging')
+        if self._stage_in_datastore:
+            self._tmp_folder = os.path.join(self._staging_folder, 'tmp')
+            self._partial_folder = os.path.join(self._staging_folder, 'partial')
+
+        # Commit DB after this many rows or seconds, 0 for both means commit after every message
+        self._commit_rows = commit_rows
+        self._commit_seconds = commit_seconds
+
+        # Write the db in datastore folder directly with WAL instead of copying it to work folder
+        self._in_place_db = in_place_db
+        # In place, keep the db as it was before the run in telegram_datamanager.db.backup
+        # WAL recovers the db after a crash, but only a backup undoes a run, at the cost of writing the whole db again
+        self._db_backup = db_backup
+
+        # Store dates as integer seconds, existing datastores are converted on open
+        self._epoch_dates = epoch_dates
+
+        # Skip downloading media already saved in any chat, link identical files
+        self._dedup_media = dedup_media
+
+        # Download large documents in chunks that survive restarts
+        self._resumable_downloads = resumable_downloads
+        # document id -> [lock, tasks using it], tasks downloading the same document take turns
+        self._resumable_locks = {}
+        # document id -> path of its last finished download, until it leaves the tmp folder
+        self._resumable_done = {}
+
+        # Timers and counters, written to metrics_path + '.json' and '.prom' at exit
+        self.metrics = Metrics()
+        self._metrics_path = metrics_path
+        # Flood waits the client sleeps through without raising also count
+        self._flood_wait_log = FloodWaitLogHandler(self.metrics)
+
+        # Requests go through rate_limiter, which also retries after flood waits
+        self.rate_limiter = rate_limiter if rate_limiter else RateLimiter()
+        if not self.rate_limiter.metrics:
+            self.rate_limiter.metrics = self.metrics
 
         # Progress related
         self._display_progress = display_progress
         self._raw_display_callback = display_callback
         self._raw_download_progress_callback = download_progress_callback
+        self._raw_chat_progress_callback = chat_progress_callback
 
         # Create Symbolic Link
         self._create_symlink = create_symlink
+        # Thread running DB work while chats are synced in parallel
+        self._db_executor = None
+        # Event loop of the parallel sync, progress is only drawn from its thread
+        self._loop = None
+
+        # chat_id -> name of chats to link at the end of update_chats
+        self._pending_links = {}
+        self._chat_links = None
+
+        self._fsck_workers = fsck_workers
+
+        # Installed until __exit__, or until __init__ fails
+        self._flood_wait_log.install()
+        try:
+            # Make all dirs
+            self._makedirs()
 
-        # Remove useless file(media id larger than max_media_id)
-        if check_media_ids:
-            self._remove_file_with_invalid_media_id()
+            self._db = self._open_db()
 
-        # Check and update personal info
-        self.update_personal_info()
+            # Names of chats and users, filled from dialog list
+            self.entity_cache = EntityCache(self._db, self._client, rate_limiter=self.rate_limiter)
+
+            # Check media files against DB, remove orphans when fsck_apply
+            if check_media_ids:
+                self.fsck(fsck_apply)
+
+            # Check and update personal info
+            self.update_personal_info()
+        except BaseException:
+            self._flood_wait_log.uninstall()
+            raise
 
     def _open_db(self):
+        if self._in_place_db:
+            return self._open_db_in_place()
+
         # File paths
         datastore_db_path = os.path.join(self._datastore_folder, 'telegram_datamanager.db')
         datastore_dblock_path = os.path.join(self._datastore_folder, 'telegram_datamanager.dblock')
@@ -82,7 +178,7 @@ class Importer:
                 sys.exit(-1)
 
             # two json match, continue previous transaction
-            return DataBase(work_db_path)
+            return DataBase(work_db_path, self._commit_rows, self._commit_seconds, epoch_dates=self._epoch_dates, metrics=self.metrics)
 
         # Normal situation
         # Make dblock; copy db to work folder; write json to both dir
@@ -97,7 +193,61 @@ class Importer:
         with open(work_json_path, 'x') as f:
             json.dump(info, f)
 
-        return DataBase(work_db_path)
+        return DataBase(work_db_path, self._commit_rows, self._commit_seconds, epoch_dates=self._epoch_dates, metrics=self.metrics)
+
+    def _open_db_in_place(self):
+        # File paths
+        datastore_db_path = os.path.join(self._datastore_folder, 'telegram_datamanager.db')
+        datastore_dbbackup_path = os.path.join(self._datastore_folder, 'telegram_datamanager.db.backup')
+        datastore_dblock_path = os.path.join(self._datastore_folder, 'telegram_datamanager.dblock')
+        datastore_json_path = os.path.join(self._datastore_folder, 'telegram_datamanager.json')
+        work_json_path = os.path.join(self._work_folder, 'telegram_datamanager.json')
+
+        if os.path.exists(datastore_dblock_path):
+            # Previous run did not finish, WAL recovers the db on open
+            if not os.path.exists(work_json_path):
+                print('Error: dblock exists at {} but json is not at {}. Please check what is going on'.format(datastore_dblock_path, work_json_path), file=sys.stderr)
+                sys.exit(-1)
+            with open(datastore_json_path) as f:
+                datastore_json = json.load(f)
+            with open(work_json_path) as f:
+                work_json = json.load(f)
+            if not datastore_json == work_json:
+                print('Error: json file in datastore folder and work folder mismatch', file=sys.stderr)
+                print('In datastore:', file=sys.stderr)
+                print(datastore_json, file=sys.stderr)
+                print('In work:', file=sys.stderr)
+                print(work_json, file=sys.stderr)
+                sys.exit(-1)
+            if not datastore_json.get('in_place_db'):
+                print('Error: previous run copied the db to work folder, run again without in place db to finish it', file=sys.stderr)
+                sys.exit(-1)
+
+            # two json match, continue previous transaction
+            return DataBase(datastore_db_path, self._commit_rows, self._commit_seconds, wal=True, epoch_dates=self._epoch_dates, metrics=self.metrics)
+
+        # json without dblock is left by a run that stopped after closing the db, nothing to recover
+        for json_path in (datastore_json_path, work_json_path):
+            if os.path.exists(json_path):
+                os.remove(json_path)
+
+        # Normal situation
+        # Make dblock; back up db; write json to both dir
+        open(datastore_dblock_path, 'x').close()
+        if self._db_backup and os.path.exists(datastore_db_path):
+            with self.metrics.phase('db_backup'):
+                DataBase.backup(datastore_db_path, datastore_dbbackup_path)
+        info = {'datastore_folder': os.path.realpath(self._datastore_folder),
+                'work_folder': os.path.realpath(self._work_folder),
+                'start_time': datetime.now().strftime('%Y-%m-%d %H-%M-%S'),
+                'in_place_db': True
+                }
+        with open(datastore_json_path, 'x') as f:
+            json.dump(info, f)
+        with open(work_json_path, 'x') as f:
+            json.dump(info, f)
+
+        return DataBase(datastore_db_path, self._commit_rows, self._commit_seconds, wal=True, epoch_dates=self._epoch_dates, metrics=self.metrics)
 
     def _close_db(self):
         # File paths
@@ -111,6 +261,16 @@ class Importer:
         # Close db file
         self._db.close()
 
+        if self._stage_in_datastore:
+            self._remove_keeping_partial(self._staging_folder)
+
+        # Nothing to copy back, closing the db checkpoints WAL into it
+        if self._in_place_db:
+            os.remove(datastore_dblock_path)
+            os.remove(datastore_json_path)
+            self._remove_keeping_partial(self._work_folder)
+            return
+
         # Make db backup if exist in datastore; copy db from work folder
         if os.path.exists(datastore_db_path):
             shutil.copyfile(datastore_db_path, datastore_dbbackup_path)
@@ -119,7 +279,76 @@ class Importer:
         # Remove dblock; Remove json from both dir and the empty work dir
         os.remove(datastore_dblock_path)
         os.remove(datastore_json_path)
-        shutil.rmtree(self._work_folder)
+        self._remove_keeping_partial(self._work_folder)
+
+    def _remove_keeping_partial(self, folder):
+        # Partial downloads survive every exit, also a crash or Ctrl-C
+        # A partial file is only removed by the rename that completes it, or by fsck once it is stale
+        keep_partial = os.path.isdir(self._partial_folder) and os.listdir(self._partial_folder)
+        for name in os.listdir(folder):
+            path = os.path.join(folder, name)
+            if path == self._partial_folder and keep_partial:
+                continue
+            if os.path.isdir(path):
+                shutil.rmtree(path)
+            else:
+                os.remove(path)
+        if not os.listdir(folder):
+            os.rmdir(folder)
+
+    def _write_metrics(self):
+        if not self._metrics_path:
+            return
+        self.metrics.write_json('{}.json'.format(self._metrics_path))
+        self.metrics.write_prometheus('{}.prom'.format(self._metrics_path))
+
+    # Telethon fetches history in pages of up to 100 messages
+    _history_page_size = 100
+
+    def _iter_history(self, chat_id, min_id, phase='history'):
+        # iter_messages with time spent waiting on the server counted as phase
+        # After a flood wait, continue after the last message
+        while True:
+            iterator = iter(self._client.iter_messages(chat_id, reverse=True, min_id=min_id))
+            count = 0
+            try:
+                while True:
+                    with self.metrics.phase(phase):
+                        if count % self._history_page_size == 0:
+                            self.metrics.count('rpc.get_history')
+                            self.rate_limiter.wait_sync('history')
+                        message = next(iterator, None)
+                        if count % self._history_page_size == 0:
+                            self.rate_limiter.success('history')
+                    if message is None:
+                        return
+                    count += 1
+                    min_id = message.id
+                    yield message
+            except FloodWaitError as e:
+                self.rate_limiter.flood_wait('history', e)
+
+    async def _aiter_history(self, chat_id, min_id):
+        while True:
+            iterator = self._client.iter_messages(chat_id, reverse=True, min_id=min_id).__aiter__()
+            count = 0
+            try:
+                while True:
+                    with self.metrics.phase('history'):
+                        if count % self._history_page_size == 0:
+                            self.metrics.count('rpc.get_history')
+                            await self.rate_limiter.wait('history')
+                        try:
+                            message = await iterator.__anext__()
+                        except StopAsyncIteration:
+                            return
+                        if count % self._history_page_size == 0:
+                            self.rate_limiter.success('history')
+                    count += 1
+                    min_id = message.id
+                    yield message
+            except FloodWaitError as e:
+                self.rate_limiter.flood_wait('history', e)
 
     def enable_progress(self):
         self._display_progress = True
@@ -127,58 +356,50 @@ class Importer:
     def disable_progress(self):
         self._display_progress = False
 
+    def _call_in_loop(self, func, *args):
+        # The writer thread hands progress updates to the event loop, so they are never drawn from two threads
+        if self._loop is not None:
+            try:
+                asyncio.get_running_loop()
+            except RuntimeError:
+                self._loop.call_soon_threadsafe(func, *args)
+                return
+        func(*args)
+
     def _display_callback(self, line0=None, line1=None, line2=None):
         if not self._display_progress:
             return
         if not self._raw_display_callback:
             return
-        self._raw_display_callback(line0, line1, line2)
+        self._call_in_loop(self._raw_display_callback, line0, line1, line2)
 
     def _download_progress_callback(self, recieved_bytes, total_bytes):
         if not self._display_progress:
             return
         if not self._raw_download_progress_callback:
             return
-        self._raw_download_progress_callback(recieved_bytes, total_bytes)
-
-    def _remove_file_with_invalid_media_id(self):
-        self._display_callback('Removing media file with invalid id')
-        # Delete all files with media_id larger than media id in the DB
-        dirs = os.listdir(self._media_folder)
-        for i, f in enumerate(dirs):
-            self._display_callback(None, '{}/{} Working on folder: {}'.format(i+1, len(dirs), f))
-            chat_folder = os.path.join(self._media_folder, f)
-            if not os.path.isdir(chat_folder):
-                continue
-            try:
-                # Convert chat_id to int
-                chat_id = int(f)
-            except ValueError:
-                continue
-            # Check if chat_id is a valid chat in DB
-            if not self._db.chat_exist(chat_id):
-                continue
-            # Get max_media_id
-            max_media_id = self._db.chat_get_media_id(chat_id)
-            # Remove all invalid files
-            files_to_remove = []
-            files = os.listdir(chat_folder)
-            for idx, ff in enumerate(files):
-                if idx % 100 is 0:
-                    self._display_callback(None, None, 'Checking files {}/{}'.format(idx, len(files)))
-                filepath = os.path.join(chat_folder, ff)
-                if not os.path.isfile(filepath):
-                    continue
-                match = re.fullmatch(r'^([0-9]+)\@.+$', ff)
-                if match and int(match.group(1)) > max_media_id:
-                    files_to_remove.append(filepath)
+        self._call_in_loop(self._raw_download_progress_callback, recieved_bytes, total_bytes)
 
-            for idx, ff in enumerate(files_to_remove):
-                if idx % 100 is 0:
-                    self._display_callback(None, None, 'Removing files {}/{}'.format(idx, len(files)))
-                # TODO: change back before commit
-                print('removed', file=sys.stderr)
-                # os.remove(ff)
+    def _chat_progress_callback(self, lane, line):
+        if not self._display_progress:
+            return
+        if not self._raw_chat_progress_callback:
+            return
+        self._call_in_loop(self._raw_chat_progress_callback, lane, line)
+
+    def fsck(self, apply=False):
+        # Report of orphan and missing media files and stale partial downloads, written to fsck.json in datastore folder
+        # apply removes orphans and stale partials, and clears missing files from the DB
+        with self.metrics.phase('fsck'):
+            self._db.flush()
+            result = Fsck(self._db, self._media_folder, self._fsck_workers, self._display_callback,
+                          partial_folder=self._partial_folder).run(apply)
+
+        with open(os.path.join(self._datastore_folder, 'fsck.json'), 'w') as f:
+            json.dump(dict(result, applied=apply), f, indent=2)
+        self._display_callback(None, '{} orphan files, {} missing files, {} stale partial downloads'.format(
+            len(result['orphans']), len(result['missing']), len(result['stale_partials'])))
+        return result
 
     def _makedirs(self):
         # Make dirs
@@ -191,10 +412,11 @@ class Importer:
         if os.path.exists(self._tmp_folder):
             shutil.rmtree(self._tmp_folder)
         os.makedirs(self._tmp_folder, mode=0o755, exist_ok=True)
+        os.makedirs(self._partial_folder, mode=0o755, exist_ok=True)
 
     def update_personal_info(self):
         self._display_callback('Updating personal info')
-        me = self._client.get_me()
+        me = self.rate_limiter.call('entities', self._client.get_me)
 
         if not me:
             raise ValueError('get_me returned null, check if client is logged in')
@@ -217,7 +439,17 @@ class Importer:
 
     def _get_matched_chat(self, allow_list=None, block_list=None):
         self._display_callback(None, 'Filtering Chat')
-        all_chats = self._client.get_dialogs(limit=None, ignore_migrated=True)
+        with self.metrics.phase('list_dialogs'):
+            if self._dialog_cache:
+                all_chats = self._dialog_cache.get_dialogs()
+            else:
+                self.metrics.count('rpc.get_dialogs')
+                all_chats = self.rate_limiter.call('dialogs', self._client.get_dialogs, limit=None, ignore_migrated=True)
+
+        # Keep stored names current
+        self.entity_cache.fill_from_dialogs(all_chats, self._dialog_cache.listed() if self._dialog_cache else None)
+        self._db.chat_update_names([(chat.id, chat.name) for chat in all_chats])
+        self._db.commit()
 
         matched = []
 
@@ -249,7 +481,7 @@ class Importer:
         count = 0
         total_bytes = 0
 
-        for message in self._client.iter_messages(chat_id, reverse=True, min_id=max_message_id):
+        for message in self._iter_history(chat_id, max_message_id, 'stat'):
             count += 1
             total_bytes += self._get_media_size_in_message(message)
 
@@ -258,34 +490,244 @@ class Importer:
         self._undownloaded_messages = count
         self._undownloaded_file_bytes = total_bytes
 
+    def _get_undownloaded_message_estimate(self, chat_id):
+        self._display_callback(None, 'Updating undownloaded message count')
+
+        # limit=0 only asks the server for the total, no message is fetched
+        with self.metrics.phase('stat'):
+            self.metrics.count('rpc.get_messages')
+            total = self.rate_limiter.call('history', self._client.get_messages, chat_id, limit=0).total
+
+        # Bytes are unknown until messages are fetched
+        self._undownloaded_messages = max(total - self._db.message_count(chat_id), 0)
+        self._undownloaded_file_bytes = None
+
+    def _saving_message_str(self, first, last=None):
+        if last is None:
+            line = 'Saving message {:,}'.format(first)
+        else:
+            line = 'Downloading media of messages {:,}-{:,}'.format(first, last)
+
+        if self._undownloaded_file_bytes is None:
+            return '{}/~{:,}'.format(line, self._undownloaded_messages)
+        return '{}/{:,}. Total bytes remaining: {:,}'.format(line, self._undownloaded_messages, self._undownloaded_file_bytes)
+
     def _get_actionstr(self, message):
         return type(message.action).__name__ if message.action else None
 
+    def _get_media_object(self, target):
+        # Photo or document a target downloads, None if it has none
+        media = target
+        if hasattr(target, 'media'):
+            media = target.media
+        if isinstance(media, types.MessageMediaPhoto):
+            media = media.photo
+        elif isinstance(media, types.MessageMediaDocument):
+            media = media.document
+        elif isinstance(media, types.MessageMediaWebPage) and isinstance(media.webpage, types.WebPage):
+            media = media.webpage.document or media.webpage.photo
+
+        if isinstance(media, (types.Photo, types.Document)):
+            return media
+        return None
+
+    def _get_media_key(self, target):
+        # (kind, telegram id) of the photo or document a target downloads, None if it has none
+        media = self._get_media_object(target)
+        if isinstance(media, types.Photo):
+            return ('photo', media.id)
+        if isinstance(media, types.Document):
+            return ('document', media.id)
+        return None
+
+    # Documents at least this large are downloaded resumably
+    _resumable_min_size = 16 * 1024 * 1024
+    # Chunk size of resumable downloads, partial files are cut to a multiple of it
+    _resumable_chunk_size = 512 * 1024
+
+    def _get_resumable_document(self, target):
+        if not self._resumable_downloads:
+            return None
+        media = self._get_media_object(target)
+        if isinstance(media, types.Document) and media.size >= self._resumable_min_size:
+            return media
+        return None
+
+    # Free space kept on the datastore filesystem after a staged download
+    _min_free_bytes = 100 * 1024 * 1024
+
+    def _get_target_size(self, target):
+        media = self._get_media_object(target)
+        if isinstance(media, types.Document):
+            return media.size
+        if isinstance(media, types.Photo) and isinstance(media.sizes[-1], types.PhotoSize):
+            return media.sizes[-1].size
+        return 0
+
+    def _check_free_space(self, target):
+        if not self._stage_in_datastore:
+            return
+        size = self._get_target_size(target)
+        free = shutil.disk_usage(self._tmp_folder).free
+        if free < size + self._min_free_bytes:
+            raise OSError('not enough free space in {} for {:,} bytes, {:,} bytes free'.format(self._tmp_folder, size, free))
+
+    def _get_document_filename(self, document):
+        for attr in document.attributes:
+            if isinstance(attr, types.DocumentAttributeFilename):
+                return attr.file_name
+        return 'document_{}{}'.format(document.id, utils.get_extension(document))
+
+    async def _download_resumable_async(self, document, folder):
+        # The same document can be in several messages downloaded at the same time
+        # Only one task writes its partial file, the others link the finished file
+        # The lock is dropped with its last task
+        entry = self._resumable_locks.setdefault(document.id, [asyncio.Lock(), 0])
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                path = os.path.join(folder, self._get_document_filename(document))
+                done_path = self._resumable_done.get(document.id)
+                if done_path:
+                    try:
+                        os.link(done_path, path)
+                        return path
+                    except OSError:
+                        # Already moved to media folder, or no hardlinks
+                        pass
+
+                await self._download_partial_async(document)
+
+                # Same filesystem, so this is a rename
+                os.replace(os.path.join(self._partial_folder, 'document_{}'.format(document.id)), path)
+                self._resumable_done[document.id] = path
+                return path
+        finally:
+            entry[1] -= 1
+            if entry[1] == 0:
+                del self._resumable_locks[document.id]
+
+    def _forget_moved_downloads(self):
+        # Finished downloads moved into the datastore or removed with their tmp folder can't be linked anymore
+        for document_id, path in list(self._resumable_done.items()):
+            if not os.path.exists(path):
+                del self._resumable_done[document_id]
+
+    async def _download_partial_async(self, document):
+        partial_path = os.path.join(self._partial_folder, 'document_{}'.format(document.id))
+
+        offset = os.path.getsize(partial_path) if os.path.exists(partial_path) else 0
+        with open(partial_path, 'ab') as f:
+            # Continue from the last complete chunk, also after a flood wait or a download that ended short
+            while offset < document.size:
+                offset -= offset % self._resumable_chunk_size
+                f.truncate(offset)
+                start = offset
+                try:
+                    await self.rate_limiter.wait('download')
+                    async for chunk in self._client.iter_download(document, offset=offset, request_size=self._resumable_chunk_size, file_size=document.size):
+                        f.write(chunk)
+                        f.flush()
+                        offset += len(chunk)
+                        self._download_progress_callback(offset, document.size)
+                        self.rate_limiter.success('download')
+                        await self.rate_limiter.wait('download')
+                except FloodWaitError as e:
+                    self.rate_limiter.flood_wait('download', e)
+                    continue
+                if offset < document.size and offset - offset % self._resumable_chunk_size <= start:
+                    # Not a ValueError, which saves the media as failed, the run stops and the next one resumes
+                    raise EOFError('download of document {} ended at {}/{}'.format(document.id, offset, document.size))
+
+    def _in_media_store(self, target):
+        if not self._dedup_media:
+            return False
+        media_key = self._get_media_key(target)
+        if not media_key:
+            return False
+        stored = self._db.media_store_get(*media_key)
+        return stored is not None and os.path.exists(stored[0])
+
+    def _hash_file(self, path):
+        sha256 = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b''):
+                sha256.update(chunk)
+        return sha256.hexdigest()
+
+    def _link_media_file(self, src_path, dst_path):
+        # Hardlink if possible, else refer to src_path in DB
+        try:
+            os.link(src_path, dst_path)
+            return dst_path
+        except OSError:
+            return src_path
+
+    def _store_media_file(self, new_path, media_key):
+        # Replace new file with a link if same content is already stored
+        name = os.path.basename(new_path).split('@', 1)[1]
+        file_hash = self._hash_file(new_path)
+        stored = self._db.media_store_get_by_hash(file_hash)
+        if stored and stored[0] != new_path and os.path.exists(stored[0]):
+            os.remove(new_path)
+            self._db.media_store_add(media_key[0], media_key[1], file_hash, stored[0], name)
+            return self._link_media_file(stored[0], new_path)
+
+        self._db.media_store_add(media_key[0], media_key[1], file_hash, new_path, name)
+        return new_path
+
     # If filename is None, then no file to move
     # If filename is -1, then download failed, save None to DB
+    # If filename is -2, then media is in media store and not downloaded
     # Else move the file and store file path to db
-    def _move_media_file(self, chat_id, filename, media_ids):
+    def _move_media_file(self, chat_id, message_id, filename, media_ids, media_key=None):
         if not filename:
             return
 
-        self._display_callback(None, None, 'Saving media file {} '.format(os.path.basename(filename)))
+        if isinstance(filename, str):
+            self._display_callback(None, None, 'Saving media file {} '.format(os.path.basename(filename)))
 
         # Allocate media_id
-        media_id = self._db.chat_get_next_media_id(chat_id)
+        if self._db.batched:
+            media_id = self._db.chat_get_next_media_id_batch(chat_id)
+        else:
+            media_id = self._db.chat_get_next_media_id(chat_id)
         # Rename and move file
-        if filename != -1:
-            filename = os.path.basename(filename)
-            new_filename = '{}@{}'.format(media_id, filename)
-            old_path = os.path.join(self._tmp_folder, filename)
+        if filename == -2:
+            stored_path, stored_name = self._db.media_store_get(*media_key)
+            new_path = os.path.join(self._media_folder, str(chat_id), '{}@{}'.format(media_id, stored_name))
+            new_path = self._link_media_file(stored_path, new_path)
+        elif filename != -1:
+            old_path = filename
+            new_filename = '{}@{}'.format(media_id, os.path.basename(filename))
             new_path = os.path.join(self._media_folder, str(chat_id), new_filename)
-            shutil.move(old_path, new_path, copy_function=shutil.copyfile)
+            self.metrics.count('bytes', os.path.getsize(old_path), chat_id)
+            with self.metrics.phase('file_move'):
+                if self._stage_in_datastore:
+                    os.replace(old_path, new_path)
+                else:
+                    shutil.move(old_path, new_path, copy_function=shutil.copyfile)
+            if self._dedup_media and media_key:
+                new_path = self._store_media_file(new_path, media_key)
         else:
             new_path = None
         # Create Media entry to db
-        self._db.media_add(chat_id, media_id, new_path)
+        if self._db.batched:
+            self._db.media_add_batch(chat_id, media_id, new_path)
+        else:
+            self._db.media_add(chat_id, media_id, new_path)
         # Update previous_entry
         if media_ids['prev'] is not 0:
-            self._db.media_update_next(chat_id, media_ids['prev'], media_id)
+            if self._db.batched:
+                self._db.media_update_next_batch(chat_id, media_ids['prev'], media_id)
+            else:
+                self._db.media_update_next(chat_id, media_ids['prev'], media_id)
+        # Map message to media
+        if self._db.batched:
+            self._db.message_media_add_batch(chat_id, message_id, media_ids['count'], media_id)
+        else:
+            self._db.message_media_add(chat_id, message_id, media_ids['count'], media_id)
+        media_ids['count'] += 1
 
         if media_ids['first'] == 0:
             media_ids['first'] = media_id
@@ -325,68 +767,157 @@ class Importer:
 
         return total_bytes
 
-    def _save_all_media(self, chat_id, message):
-        # Create dir for media folder
-        curr_chat_folder = os.path.join(self._media_folder, str(chat_id))
-        os.makedirs(curr_chat_folder, mode=0o755, exist_ok=True)
-
-        # Download everything
-        media_ids = {'first': 0, 'prev': 0}
-        # Step 1: media in document
-        try:
-            filename = message.download_media(file=self._tmp_folder, progress_callback=self._download_progress_callback)
-        except ValueError:
-            filename = -1
-        self._move_media_file(chat_id, filename, media_ids)
+    def _get_media_targets(self, message):
+        # Everything to download in a message, in the order media_ids are allocated
+        targets = []
+        if message.media:
+            targets.append(message)
 
         if message.web_preview:
             if message.web_preview.cached_page:
                 # Download all photos
                 if message.web_preview.cached_page.photos:
-                    for photo in message.web_preview.cached_page.photos:
-                        try:
-                            filename = message.client.download_media(photo, file=self._tmp_folder, progress_callback=self._download_progress_callback)
-                        except ValueError:
-                            filename = -1
-                        self._move_media_file(chat_id, filename, media_ids)
+                    targets.extend(message.web_preview.cached_page.photos)
 
                 # Download all documents
                 if message.web_preview.cached_page.documents:
-                    for doc in message.web_preview.cached_page.documents:
-                        try:
-                            filename = message.client.download_media(doc, file=self._tmp_folder, progress_callback=self._download_progress_callback)
-                        except ValueError:
-                            filename = -1
-                        self._move_media_file(chat_id, filename, media_ids)
+                    targets.extend(message.web_preview.cached_page.documents)
+
+        return targets
+
+    async def _download_media_async(self, target, folder, semaphore):
+        if await self._db_call(self._in_media_store, target):
+            return -2
+        async with semaphore:
+            os.makedirs(folder, mode=0o755, exist_ok=True)
+            self._check_free_space(target)
+            try:
+                with self.metrics.phase('download'):
+                    self.metrics.count('rpc.download')
+                    document = self._get_resumable_document(target)
+                    if document:
+                        return await self._download_resumable_async(document, folder)
+                    return await self.rate_limiter.call_async('download', self._client.download_media, target, file=folder,
+                                                              progress_callback=self._download_progress_callback)
+            except ValueError:
+                return -1
+
+    async def _download_messages_async(self, messages, prefix='', semaphore=None):
+        if semaphore is None:
+            semaphore = asyncio.Semaphore(self._concurrent_downloads)
+
+        # Each download gets its own tmp folder so files with the same name don't collide
+        tasks = []
+        for i, message in enumerate(messages):
+            for j, target in enumerate(self._get_media_targets(message)):
+                folder = os.path.join(self._tmp_folder, '{}{}_{}'.format(prefix, i, j))
+                tasks.append(self._download_media_async(target, folder, semaphore))
+        results = await asyncio.gather(*tasks)
+
+        # Split results back to messages
+        filenames = []
+        pos = 0
+        for message in messages:
+            count = len(self._get_media_targets(message))
+            filenames.append(results[pos:pos + count])
+            pos += count
+
+        return filenames
+
+    def _download_messages(self, messages):
+        return self._client.loop.run_until_complete(self._download_messages_async(messages))
+
+    def _download_media(self, target):
+        if self._in_media_store(target):
+            return -2
+        self._check_free_space(target)
+        try:
+            with self.metrics.phase('download'):
+                self.metrics.count('rpc.download')
+                document = self._get_resumable_document(target)
+                if document:
+                    return self._client.loop.run_until_complete(self._download_resumable_async(document, self._tmp_folder))
+                return self.rate_limiter.call('download', self._client.download_media, target, file=self._tmp_folder,
+                                              progress_callback=self._download_progress_callback)
+        except ValueError:
+            return -1
+
+    # If filenames is None, download all media one by one
+    # Else filenames are results of _download_messages for this message
+    def _save_all_media(self, chat_id, message, filenames=None):
+        # Create dir for media folder
+        curr_chat_folder = os.path.join(self._media_folder, str(chat_id))
+        os.makedirs(curr_chat_folder, mode=0o755, exist_ok=True)
+
+        # Download everything
+        media_ids = {'first': 0, 'prev': 0, 'count': 0}
+        targets = self._get_media_targets(message)
+        one_by_one = filenames is None
+        if one_by_one:
+            filenames = (self._download_media(target) for target in targets)
+
+        for target, filename in zip(targets, filenames):
+            self._move_media_file(chat_id, message.id, filename, media_ids, self._get_media_key(target))
+        if one_by_one:
+            # Downloads one by one are moved right away, batches forget theirs in _remove_tmp_folders
+            self._forget_moved_downloads()
 
         return media_ids['first'] if media_ids['first'] is not 0 else None
 
-    def _create_symlink_for_chat(self, chat_id, chat_name):
-        # Remove all folder ends with chat_id
-        for f in os.listdir(self._chats_folder):
-            matched = re.search(r"@(-?[0-9]+$)", f)
+    def _get_chat_links(self):
+        # chat_id -> (entry name, is link) of entries in chats folder, listed once per run
+        if self._chat_links is None:
+            self._chat_links = {}
+            with os.scandir(self._chats_folder) as it:
+                for entry in it:
+                    matched = re.search(r"@(-?[0-9]+$)", entry.name)
+                    if matched:
+                        self._chat_links.setdefault(int(matched.group(1)), []).append((entry.name, entry.is_symlink()))
+        return self._chat_links
 
-            if not matched:
+    def _create_symlink_for_chat(self, chat_id, chat_name):
+        # Links are updated together by _update_chat_links
+        self._pending_links[chat_id] = chat_name
+
+    def _update_chat_links(self):
+        chat_links = self._get_chat_links()
+        for chat_id, chat_name in self._pending_links.items():
+            name = '{}@{}'.format(chat_name, chat_id)
+            if chat_links.get(chat_id) == [(name, self._create_symlink)]:
                 continue
 
-            if int(matched.group(1)) == chat_id:
+            # Remove all folder ends with chat_id
+            for f, is_link in chat_links.get(chat_id, []):
                 folder_path = os.path.join(self._chats_folder, f)
-                if os.path.islink(folder_path):
+                if is_link:
                     os.remove(folder_path)
                 else:
                     os.rmdir(folder_path)
 
-        # Create folder
-        src_folder_path = os.path.join(self._media_folder, str(chat_id))
-        dst_folder_path = os.path.join(self._chats_folder, '{}@{}'.format(chat_name, chat_id))
-        if self._create_symlink:
-            os.symlink(os.path.relpath(src_folder_path, start=self._chats_folder), dst_folder_path, target_is_directory=True)
-        else:
-            os.mkdir(dst_folder_path, mode=0o755)
+            # Create folder
+            src_folder_path = os.path.join(self._media_folder, str(chat_id))
+            dst_folder_path = os.path.join(self._chats_folder, name)
+            if self._create_symlink:
+                os.symlink(os.path.relpath(src_folder_path, start=self._chats_folder), dst_folder_path, target_is_directory=True)
+            else:
+                os.mkdir(dst_folder_path, mode=0o755)
+            chat_links[chat_id] = [(name, self._create_symlink)]
+        self._pending_links = {}
+
+    def _get_top_message_id(self, chat):
+        # None if dialog does not tell
+        if chat.dialog and getattr(chat.dialog, 'top_message', None):
+            return chat.dialog.top_message
+        if chat.message:
+            return chat.message.id
+        return None
 
     def _filter_chat_with_new_content(self, chat_list):
         self._display_callback('Check if chat has new contents ...')
 
+        if self._fast_new_content_check:
+            return self._filter_chat_with_new_content_fast(chat_list)
+
         filtered = []
 
         # Counters
@@ -405,11 +936,234 @@ class Importer:
             # Get max downloaded message id
             max_message_id = self._db.chat_get_max_id(chat.id)
 
-            if len(self._client.get_messages(chat.id, reverse=True, min_id=max_message_id)) > 0:
+            if self._chat_has_new_message(chat, max_message_id):
                 filtered.append(chat)
 
         return filtered
 
+    def _chat_has_new_message(self, chat, max_message_id):
+        with self.metrics.phase('filter_probe'):
+            self.metrics.count('rpc.get_messages')
+            return len(self.rate_limiter.call('history', self._client.get_messages, chat.id, reverse=True, min_id=max_message_id)) > 0
+
+    def _filter_chat_with_new_content_fast(self, chat_list):
+        # Check if chat is in db, if not, create it
+        max_message_ids = self._db.chat_get_all_max_id()
+        for chat in chat_list:
+            if chat.id not in max_message_ids:
+                self._db.chat_add(chat.id, chat.name, self._get_chat_typestr(chat))
+                max_message_ids[chat.id] = 0
+        self._db.commit()
+
+        filtered = []
+        unclear = []
+        for chat in chat_list:
+            top_message_id = self._get_top_message_id(chat)
+            if top_message_id is None:
+                unclear.append(chat)
+            elif top_message_id > max_message_ids[chat.id]:
+                filtered.append(chat)
+
+        # Ask the server only for chats the dialog list can't answer
+        for i, chat in enumerate(unclear):
+            self._display_callback('Checking Chat {} {:,}/{:,}'.format(chat.name, i + 1, len(unclear)))
+            if self._chat_has_new_message(chat, max_message_ids[chat.id]):
+                filtered.append(chat)
+
+        # Keep the order of chat_list
+        filtered_ids = set(chat.id for chat in filtered)
+        return [chat for chat in chat_list if chat.id in filtered_ids]
+
+    def _save_message(self, chat, message, filenames=None):
+        self.metrics.count('messages', 1, chat.id)
+        if self._db.batched:
+            self._save_message_batched(chat, message, filenames)
+            return
+
+        # Save one message
+        # Save metadata
+        self._db.message_add(
+            chat_id=chat.id,
+            message_id=message.id,
+            message_type='service' if self._get_actionstr(message) else 'message',
+            date=message.date,
+            text=message.raw_text,
+            grouped_id=message.grouped_id,
+            edited=message.edit_date,
+            sender_id=message.from_id,
+            reply_to_message_id=message.reply_to_msg_id,
+            fwd_from=message.fwd_from.channel_id if message.fwd_from else None
+        )
+        # Check if media is present, if so, save it
+        media_id = self._save_all_media(chat.id, message, filenames)
+        if media_id:
+            self._db.message_update_media_id(chat.id, message.id, media_id)
+
+        # Update max_message_id
+        self._db.chat_update_max_id(chat.id, message.id)
+
+        self._db.commit()
+
+    def _save_message_batched(self, chat, message, filenames=None):
+        # Media first so the message row is written with its media_id
+        media_id = self._save_all_media(chat.id, message, filenames)
+        self._db.message_add_batch(
+            chat_id=chat.id,
+            message_id=message.id,
+            message_type='service' if self._get_actionstr(message) else 'message',
+            date=message.date,
+            text=message.raw_text,
+            grouped_id=message.grouped_id,
+            edited=message.edit_date,
+            sender_id=message.from_id,
+            reply_to_message_id=message.reply_to_msg_id,
+            fwd_from=message.fwd_from.channel_id if message.fwd_from else None,
+            media_id=media_id
+        )
+
+        # max_message_id is only written in the same transaction as the message
+        self._db.chat_update_max_id_batch(chat.id, message.id)
+        self._db.commit_if_due()
+
+    def _save_message_batch(self, chat, messages, count):
+        self._display_callback(None, self._saving_message_str(count, count + len(messages) - 1))
+        # Download all media at the same time, then save messages in order
+        filenames = self._download_messages(messages)
+        for message, message_filenames in zip(messages, filenames):
+            self._display_callback(None, self._saving_message_str(count))
+            count += 1
+            self._save_message(chat, message, message_filenames)
+
+        self._remove_tmp_folders()
+
+        return count
+
+    def _remove_tmp_folders(self, prefix=''):
+        # Remove per download tmp folders
+        for f in os.listdir(self._tmp_folder):
+            if f.startswith(prefix):
+                shutil.rmtree(os.path.join(self._tmp_folder, f), ignore_errors=True)
+        # The download tasks use _resumable_done in the event loop thread
+        self._call_in_loop(self._forget_moved_downloads)
+
+    async def _db_call(self, func, *args):
+        # In parallel mode DB work and file moves run in the writer thread, so they don't stall downloads
+        if self._db_executor is None:
+            return func(*args)
+        return await asyncio.get_running_loop().run_in_executor(self._db_executor, functools.partial(func, *args))
+
+    async def _db_writer(self, writer_queue):
+        # The only place DB is written in parallel mode, jobs run in the order they are queued
+        while True:
+            job = await writer_queue.get()
+            if job is None:
+                return
+            await self._db_call(job)
+
+    async def _chat_worker(self, lane, chat_queue, writer_queue, semaphore):
+        while not chat_queue.empty():
+            chat = chat_queue.get_nowait()
+            with self.metrics.phase('chat', chat.id):
+                await self._update_chat_async(lane, chat, writer_queue, semaphore)
+
+    async def _update_chat_async(self, lane, chat, writer_queue, semaphore):
+        prefix = '{}_'.format(chat.id)
+        max_message_id = await self._db_call(self._db.chat_get_max_id, chat.id)
+
+        count = 1
+        batch = []
+        batch_targets = 0
+        async for message in self._aiter_history(chat.id, max_message_id):
+            batch.append(message)
+            batch_targets += len(self._get_media_targets(message))
+            if batch_targets >= self._concurrent_downloads * 2 or len(batch) >= 100:
+                count = await self._queue_message_batch(lane, chat, batch, count, prefix, writer_queue, semaphore)
+                batch = []
+                batch_targets = 0
+        if batch:
+            count = await self._queue_message_batch(lane, chat, batch, count, prefix, writer_queue, semaphore)
+
+        self._chat_progress_callback(lane, '{}: {:,} messages saved'.format(chat.name, count - 1))
+        await writer_queue.put(self._db.flush)
+        self._create_symlink_for_chat(chat.id, chat.name)
+
+    async def _queue_message_batch(self, lane, chat, messages, count, prefix, writer_queue, semaphore):
+        self._chat_progress_callback(lane, '{}: downloading media of messages {:,}-{:,}'.format(chat.name, count, count + len(messages) - 1))
+        # Folders of each batch have their own names, the writer may still be saving the previous batch
+        prefix = '{}{}_'.format(prefix, count)
+        filenames = await self._download_messages_async(messages, prefix, semaphore)
+        for message, message_filenames in zip(messages, filenames):
+            await writer_queue.put(functools.partial(self._save_message, chat, message, message_filenames))
+        await writer_queue.put(functools.partial(self._remove_tmp_folders, prefix))
+
+        return count + len(messages)
+
+    async def _update_chats_async(self, chat_list):
+        chat_queue = asyncio.Queue()
+        for chat in chat_list:
+            chat_queue.put_nowait(chat)
+        writer_queue = asyncio.Queue(maxsize=1000)
+        semaphore = asyncio.Semaphore(self._concurrent_downloads)
+
+        # One thread, so DB work runs in the order it is queued
+        self._db_executor = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix='db_writer')
+        self._loop = asyncio.get_running_loop()
+        workers = asyncio.gather(*[self._chat_worker(lane, chat_queue, writer_queue, semaphore) for lane in range(self._parallel_chats)])
+        writer = asyncio.ensure_future(self._db_writer(writer_queue))
+        # Stop downloading if writer failed
+        writer.add_done_callback(lambda f: workers.cancel() if not f.cancelled() and f.exception() else None)
+
+        try:
+            await workers
+        finally:
+            if not writer.done():
+                await writer_queue.put(None)
+            try:
+                await writer
+            finally:
+                self._db_executor.shutdown()
+                self._db_executor = None
+                self._loop = None
+
+    def _update_chat(self, chat):
+        # Check if chat is in db, if not, create it
+        if not self._db.chat_exist(chat.id):
+            self._db.chat_add(chat.id, chat.name, self._get_chat_typestr(chat))
+            self._db.commit()
+
+        # Get max downloaded message id
+        max_message_id = self._db.chat_get_max_id(chat.id)
+
+        # Calculate # of new messages and size of all medias
+        if self._single_pass:
+            self._get_undownloaded_message_estimate(chat.id)
+        else:
+            self._get_undownloaded_message_stat(chat.id, max_message_id)
+
+        count = 1
+        # Save all message in this chat
+        if self._concurrent_downloads > 1:
+            batch = []
+            batch_targets = 0
+            for message in self._iter_history(chat.id, max_message_id):
+                batch.append(message)
+                batch_targets += len(self._get_media_targets(message))
+                if batch_targets >= self._concurrent_downloads * 2 or len(batch) >= 100:
+                    count = self._save_message_batch(chat, batch, count)
+                    batch = []
+                    batch_targets = 0
+            if batch:
+                count = self._save_message_batch(chat, batch, count)
+        else:
+            for message in self._iter_history(chat.id, max_message_id):
+                self._display_callback(None, self._saving_message_str(count))
+                # TODO: print bytes remaining
+                count += 1
+                self._save_message(chat, message)
+
+        self._db.flush()
+        self._create_symlink_for_chat(chat.id, chat.name)
+
     def update_chats(self, allow_list=None, block_list=None):
         self._display_callback('Updating Chats ...')
         # Step 1 filter chat
@@ -421,53 +1175,27 @@ class Importer:
         ignored_chats = len(matched_chat_list) - chat_total
         chat_count = 1
 
-        # Save all messages in all chats
-        for chat in filtered_chat:
-            self._display_callback('Updating Chat {} {:,}/{:,}. {} Chats ignored because no new message'.format(chat.name, chat_count, chat_total, ignored_chats))
-            chat_count += 1
-            # Check if chat is in db, if not, create it
-            if not self._db.chat_exist(chat.id):
-                self._db.chat_add(chat.id, chat.name, self._get_chat_typestr(chat))
-                self._db.commit()
-
-            # Get max downloaded message id
-            max_message_id = self._db.chat_get_max_id(chat.id)
-
-            # Calculate # of new messages and size of all medias
-            self._get_undownloaded_message_stat(chat.id, max_message_id)
-
-            count = 1
-            # Save all message in this chat
-            for message in self._client.iter_messages(chat.id, reverse=True, min_id=max_message_id):
-                self._display_callback(None, 'Saving message {:,}/{:,}. Total bytes remaining: {:,}'.format(count, self._undownloaded_messages, self._undownloaded_file_bytes))
-                # TODO: print bytes remaining
-                count += 1
-                # Save one message
-                # Save metadata
-                self._db.message_add(
-                    chat_id=chat.id,
-                    message_id=message.id,
-                    message_type='service' if self._get_actionstr(message) else 'message',
-                    date=message.date,
-                    text=message.raw_text,
-                    grouped_id=message.grouped_id,
-                    edited=message.edit_date,
-                    sender_id=message.from_id,
-                    reply_to_message_id=message.reply_to_msg_id,
-                    fwd_from=message.fwd_from.channel_id if message.fwd_from else None
-                )
-                # Check if media is present, if so, save it
-                media_id = self._save_all_media(chat.id, message)
-                if media_id:
-                    self._db.message_update_media_id(chat.id, message.id, media_id)
-
-                # Update max_message_id
-                max_message_id = message.id
-                self._db.chat_update_max_id(chat.id, max_message_id)
-
+        try:
+            # Save chats side by side
+            if self._parallel_chats > 1:
+                self._display_callback('Updating {:,} Chats, {} at a time. {} Chats ignored because no new message'.format(chat_total, self._parallel_chats, ignored_chats))
+                for chat in filtered_chat:
+                    if not self._db.chat_exist(chat.id):
+                        self._db.chat_add(chat.id, chat.name, self._get_chat_typestr(chat))
                 self._db.commit()
-
-            self._create_symlink_for_chat(chat.id, chat.name)
+                self._client.loop.run_until_complete(self._update_chats_async(filtered_chat))
+                return
+
+            # Save all messages in all chats
+            for chat in filtered_chat:
+                self._display_callback('Updating Chat {} {:,}/{:,}. {} Chats ignored because no new message'.format(chat.name, chat_count, chat_total, ignored_chats))
+                chat_count += 1
+                with self.metrics.phase('chat', chat.id):
+                    self._update_chat(chat)
+        finally:
+            # Links of chats saved so far, also when a chat failed
+            with self.metrics.phase('chat_links'):
+                self._update_chat_links()
 
     # TODO Modify
     def estimate_chats(self,  allow_list=None, block_list=None):
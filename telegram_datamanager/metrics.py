@@ -0,0 +1,147 @@
+from .fileoperation import atomic_open
+import contextlib
+import json
+import logging
+import threading
+import time
+
+
+class Metrics:
+    def __init__(self):
+        self._start = time.monotonic()
+        # phase -> wall-clock seconds with at least one task in the phase
+        self.phases = {}
+        # phase -> seconds summed over tasks, more than wall-clock when chats sync in parallel
+        self.phase_task_seconds = {}
+        # phase -> (tasks in it, when the first one entered)
+        self._active = {}
+        # counter name -> count
+        self.counters = {}
+        self.flood_wait_seconds = 0
+        # chat_id -> {'seconds': , 'messages': , 'bytes': }
+        self.chats = {}
+        # Phases and counters are also updated from Importer's writer thread
+        self._lock = threading.Lock()
+
+    def _chat(self, chat_id):
+        if chat_id not in self.chats:
+            self.chats[chat_id] = {'seconds': 0, 'messages': 0, 'bytes': 0}
+        return self.chats[chat_id]
+
+    @contextlib.contextmanager
+    def phase(self, name, chat_id=None):
+        start = time.monotonic()
+        with self._lock:
+            tasks, first_start = self._active.get(name, (0, start))
+            self._active[name] = (tasks + 1, first_start)
+        try:
+            yield
+        finally:
+            end = time.monotonic()
+            with self._lock:
+                self.phase_task_seconds[name] = self.phase_task_seconds.get(name, 0) + end - start
+                tasks, first_start = self._active[name]
+                if tasks == 1:
+                    del self._active[name]
+                    self.phases[name] = self.phases.get(name, 0) + end - first_start
+                else:
+                    self._active[name] = (tasks - 1, first_start)
+                if chat_id is not None:
+                    self._chat(chat_id)['seconds'] += end - start
+
+    def count(self, name, n=1, chat_id=None):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+            if chat_id is not None and name in ('messages', 'bytes'):
+                self._chat(chat_id)[name] += n
+
+    def add_flood_wait(self, seconds):
+        with self._lock:
+            self.counters['flood_waits'] = self.counters.get('flood_waits', 0) + 1
+            self.flood_wait_seconds += seconds
+
+    def _rate(self, amount, seconds):
+        return amount / seconds if seconds > 0 else 0
+
+    def summary(self):
+        chats = {}
+        for chat_id, chat in self.chats.items():
+            chats[str(chat_id)] = dict(chat,
+                                       messages_per_second=self._rate(chat['messages'], chat['seconds']),
+                                       bytes_per_second=self._rate(chat['bytes'], chat['seconds']))
+
+        return {
+            'run_seconds': time.monotonic() - self._start,
+            'phases': dict(self.phases),
+            'phase_task_seconds': dict(self.phase_task_seconds),
+            'counters': dict(self.counters),
+            'flood_wait_seconds': self.flood_wait_seconds,
+            'chats': chats
+        }
+
+    def _write_atomic(self, path, content):
+        # Readers such as node_exporter never see half a file
+        with atomic_open(path) as f:
+            f.write(content)
+
+    def write_json(self, path):
+        self._write_atomic(path, json.dumps(self.summary(), indent=2))
+
+    def write_prometheus(self, path):
+        summary = self.summary()
+        lines = []
+
+        lines.append('# TYPE telegram_datamanager_run_seconds gauge')
+        lines.append('telegram_datamanager_run_seconds {}'.format(summary['run_seconds']))
+        lines.append('# TYPE telegram_datamanager_flood_wait_seconds gauge')
+        lines.append('telegram_datamanager_flood_wait_seconds {}'.format(summary['flood_wait_seconds']))
+
+        lines.append('# HELP telegram_datamanager_phase_seconds Wall-clock seconds with at least one task in the phase')
+        lines.append('# TYPE telegram_datamanager_phase_seconds gauge')
+        for name, seconds in sorted(summary['phases'].items()):
+            lines.append('telegram_datamanager_phase_seconds{{phase="{}"}} {}'.format(name, seconds))
+        lines.append('# HELP telegram_datamanager_phase_task_seconds Seconds summed over tasks, can exceed run time when chats sync in parallel')
+        lines.append('# TYPE telegram_datamanager_phase_task_seconds gauge')
+        for name, seconds in sorted(summary['phase_task_seconds'].items()):
+            lines.append('telegram_datamanager_phase_task_seconds{{phase="{}"}} {}'.format(name, seconds))
+
+        lines.append('# TYPE telegram_datamanager_count gauge')
+        for name, count in sorted(summary['counters'].items()):
+            lines.append('telegram_datamanager_count{{name="{}"}} {}'.format(name, count))
+
+        for key in ('seconds', 'messages', 'bytes', 'messages_per_second', 'bytes_per_second'):
+            lines.append('# TYPE telegram_datamanager_chat_{} gauge'.format(key))
+            for chat_id, chat in sorted(summary['chats'].items()):
+                lines.append('telegram_datamanager_chat_{}{{chat_id="{}"}} {}'.format(key, chat_id, chat[key]))
+
+        self._write_atomic(path, '\n'.join(lines) + '\n')
+
+
+class FloodWaitLogHandler(logging.Handler):
+    # Counts flood waits Telethon sleeps through itself, those below the client's flood_sleep_threshold
+    # Telethon only reports them as 'Sleeping ... flood wait' log records of telethon.client.users
+    logger_name = 'telethon.client.users'
+
+    def __init__(self, metrics):
+        super().__init__(logging.INFO)
+        self._metrics = metrics
+        # Level of the logger before install, restored by uninstall
+        self._saved_level = None
+
+    def emit(self, record):
+        if isinstance(record.msg, str) and record.msg.startswith('Sleeping') and record.msg.endswith('flood wait'):
+            self._metrics.add_flood_wait(record.args[1])
+
+    def install(self):
+        logger = logging.getLogger(self.logger_name)
+        self._saved_level = logger.level
+        if logger.getEffectiveLevel() > logging.INFO:
+            logger.setLevel(logging.INFO)
+        logger.addHandler(self)
+
+    def uninstall(self):
+        logger = logging.getLogger(self.logger_name)
+        if self not in logger.handlers:
+            return
+        logger.removeHandler(self)
+        logger.setLevel(self._saved_level)
@@ -2,16 +2,49 @@ from console import sc
 import sys
 import random
 import time
+import threading
 
 
 class Progress:
-    def __init__(self, lines):
+    # fps > 0 merges updates and redraws from a background thread fps times a second
+    # plain writes changed lines as log lines instead of redrawing, for non-TTY output
+    # plain output is always merged, at plain_fps times a second unless fps is given
+    def __init__(self, lines, fps=0, plain=False, plain_fps=1):
         self._lines = lines
-        self._print_empty_lines()
+        self._fps = fps if fps or not plain else plain_fps
+        self._plain = plain
+        self._closed = False
+
+        # Latest and last drawn text of each line
+        self._buffer = [''] * lines
+        self._drawn = [''] * lines
+        self._lock = threading.Lock()
+
+        if not self._plain:
+            self._print_empty_lines()
+
+        self._thread = None
+        if self._fps:
+            self._stop = threading.Event()
+            self._thread = threading.Thread(target=self._render_loop, daemon=True)
+            self._thread.start()
 
     def __del__(self):
-        sys.stdout.write('\n')
-        sys.stdout.flush()
+        self.close()
+
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+
+        if self._thread:
+            self._stop.set()
+            self._thread.join()
+            self._render()
+
+        if not self._plain:
+            sys.stdout.write('\n')
+            sys.stdout.flush()
 
     def _print_empty_lines(self):
         for i in range(self._lines):
@@ -25,14 +58,42 @@ class Progress:
     def _go_down(self, line_diff):
         sys.stdout.write(sc.next_line(line_diff))
 
-    def update_line(self, linenum, line_str):
-        if linenum >= self._lines:
-            raise ValueError('linenum >= self._lines')
+    def _draw_line(self, linenum, line_str):
+        if self._plain:
+            if line_str:
+                sys.stdout.write('{}\n'.format(line_str))
+            return
 
         line_diff = self._lines-linenum
         if line_diff > 0:
             self._go_up_and_clear_line(line_diff)
         sys.stdout.write(line_str)
-        sys.stdout.flush()
         if line_diff > 0:
             self._go_down(line_diff)
+
+    def _render(self):
+        with self._lock:
+            changed = [(i, line_str) for i, line_str in enumerate(self._buffer) if line_str != self._drawn[i]]
+            for i, line_str in changed:
+                self._drawn[i] = line_str
+
+        if not changed:
+            return
+        for i, line_str in changed:
+            self._draw_line(i, line_str)
+        sys.stdout.flush()
+
+    def _render_loop(self):
+        while not self._stop.wait(1 / self._fps):
+            self._render()
+
+    def update_line(self, linenum, line_str):
+        if linenum >= self._lines:
+            raise ValueError('linenum >= self._lines')
+
+        with self._lock:
+            self._buffer[linenum] = line_str
+
+        # Draw now unless the background thread does it
+        if not self._thread:
+            self._render()
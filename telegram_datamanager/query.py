@@ -0,0 +1,87 @@
+from .db import DataBase
+import collections
+import os
+
+
+class Query:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    # Read-only lookups on a datastore, safe to use while a sync writes it in place
+    # Pages return (messages, cursor), pass cursor back for the next page, None when there is no more
+    # cache_size results are kept, a chat's results are dropped when its max_message_id changes
+    # Cached results are shared between calls, do not modify them
+    def __init__(self, datastore_folder, cache_size=1024):
+        self._db = DataBase(os.path.join(datastore_folder, 'telegram_datamanager.db'), read_only=True)
+        self._cache_size = cache_size
+        # key -> result, least recently used first
+        self._cache = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def close(self):
+        self._db.close()
+
+    def clear_cache(self):
+        self._cache.clear()
+
+    def _cached(self, key, chat_id, func):
+        # Stored messages never change, only new ones are added
+        key = (key, self._db.chat_get_max_id(chat_id))
+        if key in self._cache:
+            self.hits += 1
+            self._cache.move_to_end(key)
+            return self._cache[key]
+
+        self.misses += 1
+        result = func()
+        self._cache[key] = result
+        if len(self._cache) > self._cache_size:
+            self._cache.popitem(last=False)
+        return result
+
+    def message(self, chat_id, message_id):
+        def get():
+            row = self._db.message_get(chat_id, message_id)
+            return self._db.message_to_dict(row) if row else None
+        return self._cached(('message', chat_id, message_id), chat_id, get)
+
+    def messages(self, chat_id, date_from=None, date_to=None, cursor=None, limit=100):
+        # Messages in [date_from, date_to) by date, dates are datetimes
+        def get():
+            rows = self._db.message_get_date_page(chat_id, date_from, date_to, cursor, limit)
+            next_cursor = (rows[-1][3], rows[-1][0]) if len(rows) == limit else None
+            return [self._db.message_to_dict(row) for row in rows], next_cursor
+        return self._cached(('messages', chat_id, date_from, date_to, cursor, limit), chat_id, get)
+
+    def reply_chain(self, chat_id, message_id, limit=100):
+        # The message first, then the message it replies to and so on
+        def get():
+            return [self._db.message_to_dict(row) for row in self._db.message_get_reply_chain(chat_id, message_id, limit)]
+        return self._cached(('reply_chain', chat_id, message_id, limit), chat_id, get)
+
+    def replies(self, chat_id, message_id, cursor=None, limit=100):
+        # Messages replying to message_id, cursor is the last message_id of the previous page
+        def get():
+            rows = self._db.message_get_replies(chat_id, message_id, cursor or 0, limit)
+            next_cursor = rows[-1][0] if len(rows) == limit else None
+            return [self._db.message_to_dict(row) for row in rows], next_cursor
+        return self._cached(('replies', chat_id, message_id, cursor, limit), chat_id, get)
+
+    def album(self, chat_id, grouped_id):
+        def get():
+            return [self._db.message_to_dict(row) for row in self._db.message_get_album(chat_id, grouped_id)]
+        return self._cached(('album', chat_id, grouped_id), chat_id, get)
+
+    def media(self, chat_id, message_ids):
+        # message_id -> [(media_id, file)] for messages of one page, in one query
+        if not message_ids:
+            return {}
+
+        def get():
+            media = self._db.message_media_get_range(chat_id, min(message_ids), max(message_ids))
+            return {message_id: media.get(message_id, []) for message_id in message_ids}
+        return self._cached(('media', chat_id, tuple(sorted(message_ids))), chat_id, get)
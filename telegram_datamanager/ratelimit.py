@@ -0,0 +1,130 @@
+from telethon.errors import FloodWaitError
+import asyncio
+import collections
+import threading
+import time
+
+
+class _Bucket:
+    def __init__(self, rate, burst):
+        # Requests per second, 0 is unlimited
+        self.max_rate = rate
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        # No request of this class before this time
+        self.blocked_until = 0
+        # Flood waits since the last success
+        self.floods = 0
+        # Times of recent requests, to guess a rate for unlimited classes
+        self.recent = collections.deque(maxlen=100)
+
+
+class RateLimiter:
+    # One token bucket per RPC class, shared by all workers
+    # A flood wait blocks only its class and halves its rate, successes bring the rate back up
+    # rates: class -> requests per second, missing or 0 is unlimited until the first flood wait
+    classes = ('history', 'download', 'dialogs', 'entities')
+
+    def __init__(self, rates=None, burst=5, max_retries=5, metrics=None):
+        rates = rates if rates else {}
+        for name in rates:
+            if name not in self.classes:
+                raise ValueError('unknown RPC class {}'.format(name))
+        self._buckets = {name: _Bucket(rates.get(name, 0), burst) for name in self.classes}
+        # Flood waits in a row before the error is raised
+        self._max_retries = max_retries
+        # Metrics flood waits are counted into
+        self.metrics = metrics
+        self._lock = threading.Lock()
+
+    # Tokens this close to 1 count as 1
+    _epsilon = 1e-9
+
+    def _reserve(self, name):
+        # Take a token, or return seconds to wait before trying again
+        with self._lock:
+            bucket = self._buckets[name]
+            now = time.monotonic()
+            if now < bucket.blocked_until:
+                return bucket.blocked_until - now
+
+            if bucket.rate:
+                bucket.tokens = min(bucket.burst, bucket.tokens + (now - bucket.updated) * bucket.rate)
+                bucket.updated = now
+                # Refill rounding leaves tokens just under 1, a wait too short to move the clock would spin
+                if bucket.tokens < 1 - self._epsilon:
+                    return (1 - bucket.tokens) / bucket.rate
+                bucket.tokens -= 1
+
+            bucket.recent.append(now)
+            return 0
+
+    def wait_sync(self, name):
+        while True:
+            seconds = self._reserve(name)
+            if not seconds:
+                return
+            time.sleep(seconds)
+
+    async def wait(self, name):
+        # Only coroutines of this class wait, others keep going
+        while True:
+            seconds = self._reserve(name)
+            if not seconds:
+                return
+            await asyncio.sleep(seconds)
+
+    def success(self, name):
+        with self._lock:
+            bucket = self._buckets[name]
+            bucket.floods = 0
+            if bucket.rate and (not bucket.max_rate or bucket.rate < bucket.max_rate):
+                bucket.rate *= 1.05
+                if bucket.max_rate:
+                    bucket.rate = min(bucket.rate, bucket.max_rate)
+
+    def flood_wait(self, name, error):
+        # Block the class for the requested time and slow it down, raise error after max_retries in a row
+        if self.metrics:
+            self.metrics.add_flood_wait(error.seconds)
+        with self._lock:
+            bucket = self._buckets[name]
+            now = time.monotonic()
+            bucket.floods += 1
+            if bucket.floods > self._max_retries:
+                raise error
+
+            bucket.blocked_until = max(bucket.blocked_until, now + error.seconds)
+            rate = bucket.rate
+            if not rate:
+                # Rate that caused the flood wait, from recent requests
+                elapsed = bucket.recent[-1] - bucket.recent[0] if bucket.recent else 0
+                rate = (len(bucket.recent) - 1) / elapsed if elapsed > 0 else 1
+            bucket.rate = max(rate / 2, 0.05)
+            # Tokens refill from the end of the wait, not during it
+            bucket.tokens = 0
+            bucket.updated = bucket.blocked_until
+
+    def call(self, name, func, *args, **kwargs):
+        while True:
+            self.wait_sync(name)
+            try:
+                result = func(*args, **kwargs)
+            except FloodWaitError as e:
+                self.flood_wait(name, e)
+                continue
+            self.success(name)
+            return result
+
+    async def call_async(self, name, func, *args, **kwargs):
+        while True:
+            await self.wait(name)
+            try:
+                result = await func(*args, **kwargs)
+            except FloodWaitError as e:
+                self.flood_wait(name, e)
+                continue
+            self.success(name)
+            return result
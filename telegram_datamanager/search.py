@@ -0,0 +1,45 @@
+from .db import DataBase
+from datetime import datetime, timezone
+import argparse
+import os
+import sys
+
+
+def _parse_date(value):
+    return datetime.strptime(value, '%Y-%m-%d').replace(tzinfo=timezone.utc)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Search messages in a datastore')
+    parser.add_argument('datastore_folder')
+    parser.add_argument('query', nargs='?', help='FTS5 query, e.g. word, "a phrase", a OR b, pre*')
+    parser.add_argument('--chat', type=int, help='only messages of this chat_id')
+    parser.add_argument('--since', type=_parse_date, help='YYYY-MM-DD, UTC')
+    parser.add_argument('--until', type=_parse_date, help='YYYY-MM-DD, UTC, exclusive')
+    parser.add_argument('--limit', type=int, default=20, help='results per page')
+    parser.add_argument('--page', type=int, default=1)
+    parser.add_argument('--rebuild', action='store_true', help='index all messages again')
+    args = parser.parse_args(argv)
+    if not args.query and not args.rebuild:
+        parser.error('query is required')
+
+    # Searching never writes, so it can run while a sync writes the datastore
+    db = DataBase(os.path.join(args.datastore_folder, 'telegram_datamanager.db'), read_only=not args.rebuild)
+    try:
+        if args.rebuild:
+            db.message_search_rebuild()
+        if not args.query:
+            return 0
+
+        results = db.message_search(args.query, chat_id=args.chat, date_from=args.since, date_to=args.until,
+                                    limit=args.limit, offset=(args.page - 1) * args.limit)
+        for chat_id, message_id, date, snippet in results:
+            print('{} {}/{} {}'.format(date, chat_id, message_id, snippet.replace('\n', ' ')))
+    finally:
+        db.close()
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,47 @@
+from telethon import TelegramClient, utils
+from telethon.tl import custom
+from telethon.extensions import BinaryReader
+import asyncio
+import base64
+
+
+# TL objects are stored in JSON as base64 of their bytes, lists of them as lists
+
+def encode(tlobject):
+    if tlobject is None:
+        return None
+    if isinstance(tlobject, list):
+        return [encode(o) for o in tlobject]
+    return base64.b64encode(bytes(tlobject)).decode('ascii')
+
+
+def decode(data):
+    if data is None:
+        return None
+    if isinstance(data, list):
+        return [decode(d) for d in data]
+    return BinaryReader(base64.b64decode(data)).tgread_object()
+
+
+def make_dialog(client, dialog, entity, message):
+    # Dialog like get_dialogs returns, from its decoded parts
+    entities = {utils.get_peer_id(entity): entity}
+    if message is not None:
+        message._finish_init(client, entities, None)
+    return custom.Dialog(client, dialog, entities, message)
+
+
+class TotalList(list):
+    # get_messages result, list with server reported total
+    total = 0
+
+
+class OfflineClient(TelegramClient):
+    # Base of clients that answer without a connection, like FakeClient and ReplayClient
+    # Methods return results when called outside the event loop and coroutines inside it, like telethon.sync
+    def _run(self, coro):
+        try:
+            asyncio.get_running_loop()
+            return coro
+        except RuntimeError:
+            return self.loop.run_until_complete(coro)
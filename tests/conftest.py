@@ -0,0 +1,44 @@
+import os
+import sqlite3
+import sys
+
+import pytest
+
+# Tests import the repo packages from the repo root
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmarks.fake_client import FakeClient
+from telegram_datamanager.importer import Importer
+from telegram_datamanager.db import DataBase
+
+
+class Datastore:
+    # Datastore and work folder of one test, synced from a FakeClient
+    def __init__(self, folder):
+        self.folder = os.path.join(folder, 'datastore')
+        self.work_folder = os.path.join(folder, 'work')
+        self.db_path = os.path.join(self.folder, 'telegram_datamanager.db')
+        self.media_folder = os.path.join(self.folder, 'media')
+        DataBase(self.db_path).close()
+
+    def sync(self, client, **options):
+        with Importer(client, self.folder, self.work_folder, **options) as im:
+            im.update_chats()
+        return im
+
+    def query(self, sql, params=()):
+        conn = sqlite3.connect(self.db_path)
+        try:
+            return conn.execute(sql, params).fetchall()
+        finally:
+            conn.close()
+
+
+@pytest.fixture
+def datastore(tmp_path):
+    return Datastore(str(tmp_path))
+
+
+@pytest.fixture
+def client():
+    return FakeClient(chats=3, messages=120, media_ratio=0.3)
@@ -0,0 +1,36 @@
+from benchmarks.fake_client import FakeClient
+from telegram_datamanager.cassette import RecordingClient, ReplayClient
+from telegram_datamanager.dialogs import DialogCache
+from conftest import Datastore
+
+import pytest
+
+_messages_sql = 'SELECT chat_id, message_id, text from Message ORDER BY chat_id, message_id'
+
+
+def test_replay_matches_recording(datastore, tmp_path):
+    path = str(tmp_path / 'cassette.jsonl')
+    recorder = RecordingClient(FakeClient(chats=3, messages=60, media_ratio=0.3), path)
+    datastore.sync(recorder)
+    recorder.save()
+
+    replay = ReplayClient(path, time_scale=0)
+    replay_datastore = Datastore(str(tmp_path / 'replay'))
+    replay_datastore.sync(replay)
+    assert replay_datastore.query(_messages_sql) == datastore.query(_messages_sql)
+
+
+def test_partial_dialog_refresh_is_not_a_full_list(tmp_path):
+    path = str(tmp_path / 'cassette.jsonl')
+    client = FakeClient(chats=5, messages=10)
+    cache_path = str(tmp_path / 'dialog_cache.json')
+    DialogCache(client, cache_path).get_dialogs()
+
+    # Refresh of the cached dialogs stops at the first unchanged one
+    recorder = RecordingClient(client, path)
+    assert len(DialogCache(recorder, cache_path).get_dialogs()) == 5
+    recorder.save()
+
+    replay = ReplayClient(path, time_scale=0)
+    with pytest.raises(KeyError):
+        replay.get_dialogs()
@@ -0,0 +1,164 @@
+from telegram_datamanager.db import DataBase
+from datetime import datetime, timedelta, timezone
+import sqlite3
+
+import pytest
+
+
+def _date(i):
+    return datetime(2020, 1, 1, tzinfo=timezone.utc) + timedelta(minutes=i)
+
+
+def test_batched_max_message_id_only_with_its_messages(tmp_path):
+    path = str(tmp_path / 'batch.db')
+    db = DataBase(path, commit_rows=10)
+    db.chat_add(1, 'chat', 'user')
+    db.commit()
+    for i in range(1, 26):
+        db.message_add_batch(1, i, 'message', _date(i), 'text {}'.format(i))
+        db.chat_update_max_id_batch(1, i)
+        db.commit_if_due()
+
+    # Crash, pending rows and max_message_id are lost together
+    db._conn.close()
+
+    conn = sqlite3.connect(path)
+    max_message_id = conn.execute('SELECT max_message_id from Chat WHERE chat_id=1').fetchone()[0]
+    stored = [row[0] for row in conn.execute('SELECT message_id from Message WHERE chat_id=1 ORDER BY message_id')]
+    conn.close()
+    assert max_message_id == 20
+    assert stored == list(range(1, 21))
+
+
+def test_batched_flush_on_close(tmp_path):
+    path = str(tmp_path / 'batch.db')
+    db = DataBase(path, commit_seconds=3600)
+    db.chat_add(1, 'chat', 'user')
+    db.commit()
+    for i in range(1, 6):
+        db.message_add_batch(1, i, 'message', _date(i), 'text')
+        db.chat_update_max_id_batch(1, i)
+        db.commit_if_due()
+    db.close()
+
+    db = DataBase(path)
+    assert db.chat_get_max_id(1) == 5
+    assert db.message_count(1) == 5
+    db.close()
+
+
+def _create_v1_0_0(path):
+    # Schema and rows as written before migrations existed
+    DataBase.__new__(DataBase)._create(path)
+    conn = sqlite3.connect(path)
+    conn.execute("INSERT into Chat VALUES(1, 'chat', 'user', 3, 3)")
+    conn.execute("INSERT into Message VALUES(1, 1, 0, 'message', '2020-01-01 00:00:00', 'hello world', NULL, NULL, NULL, NULL, 1)")
+    conn.execute("INSERT into Message VALUES(2, 1, 0, 'message', '2020-01-02 00:00:00', 'second message', '2020-01-03 00:00:00', NULL, 1, NULL, NULL)")
+    conn.execute("INSERT into Message VALUES(3, 1, 0, 'message', '2020-01-04 00:00:00', 'third', NULL, NULL, NULL, NULL, 3)")
+    conn.execute("INSERT into Media VALUES(1, 1, 'a.jpg', 2)")
+    conn.execute("INSERT into Media VALUES(1, 2, 'b.jpg', NULL)")
+    conn.execute("INSERT into Media VALUES(1, 3, 'c.jpg', NULL)")
+    conn.execute("INSERT into ProfilePhoto VALUES('2019-12-31 00:00:00', 'p.jpg')")
+    conn.commit()
+    conn.close()
+
+
+def _indexes(db):
+    return sorted(row[0] for row in db._conn.execute(
+        "SELECT name from sqlite_master WHERE type='index' AND tbl_name='Message' AND sql IS NOT NULL"))
+
+
+def test_migrate_from_v1_0_0(tmp_path):
+    path = str(tmp_path / 'old.db')
+    _create_v1_0_0(path)
+
+    db = DataBase(path)
+    assert db._version() == DataBase._migrations[-1][0]
+    assert _indexes(db) == ['message_chat_date', 'message_chat_grouped', 'message_chat_id', 'message_chat_reply', 'message_sender']
+    assert db._conn.execute('PRAGMA journal_mode').fetchone()[0] == 'wal'
+    # MessageMedia is filled from the Media.next_id chains
+    assert db.message_media_get(1, 1) == [(1, 'a.jpg'), (2, 'b.jpg')]
+    assert db.message_media_get(1, 3) == [(3, 'c.jpg')]
+    if db._fts:
+        assert [row[1] for row in db.message_search('message')] == [2]
+    db.close()
+
+
+def test_interrupted_migration_rolls_back(tmp_path, monkeypatch):
+    path = str(tmp_path / 'old.db')
+    _create_v1_0_0(path)
+
+    def _crash(db):
+        DataBase._migrate_media_store(db)
+        raise KeyboardInterrupt()
+    migrations = DataBase._migrations
+    monkeypatch.setattr(DataBase, '_migrations', migrations[:3] + (('V1.4.0', _crash),) + migrations[4:])
+    with pytest.raises(KeyboardInterrupt):
+        DataBase(path)
+
+    # The schema change went with its version
+    conn = sqlite3.connect(path)
+    assert conn.execute('SELECT version from General').fetchone()[0] == 'V1.3.0'
+    assert conn.execute("SELECT name from sqlite_master WHERE name='MediaStore'").fetchone() is None
+    conn.close()
+
+    monkeypatch.setattr(DataBase, '_migrations', migrations)
+    db = DataBase(path)
+    assert db._version() == migrations[-1][0]
+    db.close()
+
+
+def test_migrate_half_migrated(tmp_path):
+    # Tables of later versions already exist, as left by a crash before migrations were transactions
+    path = str(tmp_path / 'old.db')
+    _create_v1_0_0(path)
+    DataBase(path).close()
+    conn = sqlite3.connect(path)
+    conn.execute("UPDATE General SET version='V1.2.0'")
+    conn.commit()
+    conn.close()
+
+    db = DataBase(path)
+    assert db._version() == DataBase._migrations[-1][0]
+    assert db.message_media_get(1, 1) == [(1, 'a.jpg'), (2, 'b.jpg')]
+    db.close()
+
+
+def test_migrate_and_convert_to_epoch(tmp_path):
+    path = str(tmp_path / 'old.db')
+    _create_v1_0_0(path)
+
+    db = DataBase(path)
+    indexes = _indexes(db)
+    db.close()
+
+    db = DataBase(path, epoch_dates=True)
+    assert db._date_format == 'epoch'
+    assert _indexes(db) == indexes
+    row = db._conn.execute('SELECT date, edited from Message WHERE message_id=2').fetchone()
+    assert row == (int(datetime(2020, 1, 2, tzinfo=timezone.utc).timestamp()), int(datetime(2020, 1, 3, tzinfo=timezone.utc).timestamp()))
+    assert db.message_to_dict(db.message_get(1, 2))['date'] == '2020-01-02 00:00:00'
+    assert db._conn.execute("SELECT typeof(date) from ProfilePhoto").fetchone()[0] == 'integer'
+    if db._fts:
+        assert [row[1] for row in db.message_search('third')] == [3]
+    db.close()
+
+
+def test_interrupted_epoch_conversion_finishes_on_next_open(tmp_path):
+    path = str(tmp_path / 'old.db')
+    _create_v1_0_0(path)
+
+    db = DataBase(path)
+    columns = ('message_id', 'chat_id', 'grouped_id', 'type', 'date', 'text',
+               'edited', 'sender_id', 'reply_to_message_id', 'fwd_from', 'media_id')
+    db._convert_table_dates('Message', db._message_table_sql('Message_epoch', 'integer'), columns, ('date', 'edited'), 1)
+    db._conn.execute('DELETE from Message_epoch WHERE rowid > 1')
+    db._conn.commit()
+    db.close()
+
+    # Finished without epoch_dates, so nothing writes the half converted db
+    db = DataBase(path)
+    assert db._date_format == 'epoch'
+    assert db.message_count(1) == 3
+    assert 'message_chat_date' in _indexes(db)
+    db.close()
@@ -0,0 +1,45 @@
+import json
+import os
+
+from benchmarks.fake_client import FakeClient
+from telegram_datamanager.db import DataBase
+from telegram_datamanager.dialogs import DialogCache
+from telegram_datamanager.entities import EntityCache
+
+
+def _fill(tmp_path, client, dialog_cache):
+    db = DataBase(os.path.join(str(tmp_path), 'entities.db'))
+    cache = EntityCache(db, client)
+    cache.fill_from_dialogs(dialog_cache.get_dialogs(), dialog_cache.listed())
+    return db, cache
+
+
+def test_listed_names_skip_get_entity(tmp_path):
+    client = FakeClient(chats=3, messages=10)
+    dialog_cache = DialogCache(client)
+    db, cache = _fill(tmp_path, client, dialog_cache)
+    for dialog in dialog_cache.get_dialogs():
+        assert cache.get_name(dialog.id) == dialog.name
+    db.close()
+    assert 'get_entity' not in client.calls
+
+
+def test_stale_snapshot_names_are_fetched(tmp_path):
+    client = FakeClient(chats=3, messages=10)
+    cache_path = str(tmp_path / 'dialog_cache.json')
+    DialogCache(client, cache_path).get_dialogs()
+
+    # Dialogs listed longer ago than the ttl
+    with open(cache_path) as f:
+        snapshot = json.load(f)
+    for entry in snapshot['dialogs']:
+        entry[3] = 0
+    with open(cache_path, 'w') as f:
+        json.dump(snapshot, f)
+
+    dialog_cache = DialogCache(client, cache_path)
+    db, cache = _fill(tmp_path, client, dialog_cache)
+    for dialog in dialog_cache.get_dialogs():
+        assert cache.get_name(dialog.id) == dialog.name
+    db.close()
+    assert client.calls['get_entity'] == 3
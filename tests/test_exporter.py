@@ -0,0 +1,59 @@
+from benchmarks.fake_client import FakeClient
+from telegram_datamanager.exporter import Exporter
+import json
+import os
+import sqlite3
+
+import pytest
+
+
+def _export(datastore, export_folder, **kwargs):
+    with Exporter(datastore.folder, export_folder, **kwargs) as ex:
+        return ex.export_chats()
+
+
+def test_export_writes_every_message(datastore, client, tmp_path):
+    datastore.sync(client)
+    export_folder = str(tmp_path / 'export')
+    assert _export(datastore, export_folder, page_size=7) == len(client.chats)
+
+    for chat in client.chats:
+        with open(os.path.join(export_folder, str(chat.id), 'messages.jsonl')) as f:
+            messages = [json.loads(line) for line in f]
+        assert [m['message_id'] for m in messages] == list(range(1, chat.messages + 1))
+        with_media = [m for m in messages if m['media']]
+        assert with_media and all(os.path.exists(media['file']) for m in with_media for media in m['media'])
+        assert os.path.exists(os.path.join(export_folder, str(chat.id), 'messages.html'))
+
+
+def test_export_skips_unchanged_chats(datastore, tmp_path):
+    export_folder = str(tmp_path / 'export')
+    datastore.sync(FakeClient(chats=3, messages=50))
+    assert _export(datastore, export_folder) == 3
+    assert _export(datastore, export_folder) == 0
+
+    # Only the chat with new messages is written again
+    datastore.sync(FakeClient(chats=3, messages=[50, 60, 50]))
+    mtimes = {name: os.path.getmtime(os.path.join(export_folder, name, 'messages.jsonl')) for name in os.listdir(export_folder)
+              if os.path.isdir(os.path.join(export_folder, name))}
+    assert _export(datastore, export_folder) == 1
+    changed = [name for name, mtime in mtimes.items() if os.path.getmtime(os.path.join(export_folder, name, 'messages.jsonl')) != mtime]
+    assert len(changed) == 1
+    with open(os.path.join(export_folder, changed[0], 'messages.jsonl')) as f:
+        assert sum(1 for line in f) == 60
+
+
+def test_export_reads_only(datastore, tmp_path):
+    export_folder = str(tmp_path / 'export')
+    with pytest.raises(FileNotFoundError):
+        Exporter(str(tmp_path / 'missing'), export_folder)
+    assert not os.path.exists(str(tmp_path / 'missing'))
+
+    # Migrations are left to a writable open
+    conn = sqlite3.connect(datastore.db_path)
+    with conn:
+        conn.execute("UPDATE General SET version='V1.7.0'")
+    conn.close()
+    with pytest.raises(ValueError):
+        Exporter(datastore.folder, export_folder)
+    assert datastore.query('SELECT version from General') == [('V1.7.0',)]
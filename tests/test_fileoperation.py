@@ -0,0 +1,20 @@
+import os
+
+from telegram_datamanager.fileoperation import atomic_open
+
+import pytest
+
+
+def test_failed_write_keeps_old_file(tmp_path):
+    path = str(tmp_path / 'state.json')
+    with atomic_open(path) as f:
+        f.write('old')
+
+    with pytest.raises(RuntimeError):
+        with atomic_open(path) as f:
+            f.write('half')
+            raise RuntimeError()
+
+    with open(path) as f:
+        assert f.read() == 'old'
+    assert os.listdir(str(tmp_path)) == ['state.json']
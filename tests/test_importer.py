@@ -0,0 +1,240 @@
+from benchmarks.fake_client import FakeClient
+from telegram_datamanager.importer import Importer
+from telegram_datamanager.db import DataBase
+import json
+import os
+import threading
+import time
+
+import pytest
+
+
+class _Crash(Exception):
+    pass
+
+
+def _crash_after(client, rpc, calls):
+    # Raise _Crash at the calls-th call of rpc
+    original = client._rpc
+    count = {'n': 0}
+
+    async def _rpc(name):
+        if name == rpc:
+            count['n'] += 1
+            if count['n'] == calls:
+                raise _Crash()
+        await original(name)
+    client._rpc = _rpc
+
+
+def _assert_complete(datastore, client):
+    for chat in client.chats:
+        stored = [row[0] for row in datastore.query('SELECT message_id from Message WHERE chat_id=? ORDER BY message_id', (chat.id,))]
+        assert stored == list(range(1, chat.messages + 1))
+        assert datastore.query('SELECT max_message_id from Chat WHERE chat_id=?', (chat.id,)) == [(chat.messages,)]
+
+
+def test_sync_stores_every_message(datastore, client):
+    datastore.sync(client)
+    _assert_complete(datastore, client)
+    assert not os.path.exists(datastore.work_folder)
+    paths = datastore.query('SELECT file from Media')
+    assert paths and all(os.path.exists(path) for (path,) in paths)
+
+    # Nothing new, nothing fetched again
+    client = FakeClient(chats=3, messages=120, media_ratio=0.3)
+    datastore.sync(client)
+    _assert_complete(datastore, client)
+    assert 'get_file' not in client.calls
+
+
+def test_interrupted_message_leaves_no_media(datastore, monkeypatch):
+    # Interrupted after the message's media rows were queued, before its Message row
+    message_add_batch = DataBase.message_add_batch
+
+    def _interrupt(db, chat_id, message_id, *args, **kwargs):
+        if message_id == 10:
+            raise KeyboardInterrupt()
+        message_add_batch(db, chat_id, message_id, *args, **kwargs)
+    monkeypatch.setattr(DataBase, 'message_add_batch', _interrupt)
+    with pytest.raises(KeyboardInterrupt):
+        datastore.sync(FakeClient(chats=1, messages=30, media_ratio=1.0), commit_rows=1000)
+    assert datastore.query('SELECT count(*) from MessageMedia WHERE message_id=10') == [(0,)]
+
+    monkeypatch.setattr(DataBase, 'message_add_batch', message_add_batch)
+    client = FakeClient(chats=1, messages=30, media_ratio=1.0)
+    datastore.sync(client, commit_rows=1000)
+    _assert_complete(datastore, client)
+    assert datastore.query('''SELECT count(*) from Message m JOIN MessageMedia mm
+        ON mm.chat_id=m.chat_id AND mm.message_id=m.message_id AND mm.ordinal=0 WHERE mm.media_id!=m.media_id''') == [(0,)]
+
+
+@pytest.mark.parametrize('options', [
+    {},
+    {'commit_rows': 50},
+    {'commit_rows': 50, 'in_place_db': True},
+    {'parallel_chats': 3, 'concurrent_downloads': 4, 'commit_rows': 50},
+])
+def test_sync_resumes_after_crash(datastore, options):
+    client = FakeClient(chats=3, messages=250, media_ratio=0.3)
+    _crash_after(client, 'get_history', 4)
+    with pytest.raises(_Crash):
+        datastore.sync(client, **options)
+
+    # max_message_id never runs ahead of stored messages
+    for chat_id, max_message_id in datastore.query('SELECT chat_id, max_message_id from Chat'):
+        stored = datastore.query('SELECT count(*), max(message_id) from Message WHERE chat_id=?', (chat_id,))[0]
+        assert max_message_id == (stored[1] or 0)
+        assert stored[0] == max_message_id
+
+    client = FakeClient(chats=3, messages=250, media_ratio=0.3)
+    datastore.sync(client, **options)
+    _assert_complete(datastore, client)
+
+
+def test_parallel_progress_drawn_from_loop_thread(datastore):
+    threads = set()
+
+    def _record(*args):
+        threads.add(threading.get_ident())
+
+    client = FakeClient(chats=3, messages=120, media_ratio=0.3)
+    datastore.sync(client, parallel_chats=3, concurrent_downloads=4, display_progress=True, display_callback=_record,
+                   download_progress_callback=_record, chat_progress_callback=_record)
+    _assert_complete(datastore, client)
+    assert threads == {threading.get_ident()}
+
+
+def test_resumable_download_survives_crash(datastore):
+    size = 20 * 1024 * 1024
+    client = FakeClient(chats=1, messages=2, media_ratio=1.0, document_ratio=1.0, media_size=size)
+    _crash_after(client, 'get_file', 10)
+    with pytest.raises(_Crash):
+        datastore.sync(client, resumable_downloads=True)
+    partial_folder = os.path.join(datastore.work_folder, 'partial')
+    assert os.listdir(partial_folder)
+
+    client = FakeClient(chats=1, messages=2, media_ratio=1.0, document_ratio=1.0, media_size=size)
+    datastore.sync(client, resumable_downloads=True)
+    chunks = size // Importer._resumable_chunk_size
+    assert client.calls['get_file'] == 2 * chunks - 9
+    assert not os.path.exists(datastore.work_folder)
+    for (path,) in datastore.query('SELECT file from Media'):
+        assert os.path.getsize(path) == size
+
+
+def _end_short(client, chunks, times):
+    # The first times downloads end after chunks chunks
+    iter_download = client.iter_download
+    count = {'n': 0}
+
+    async def _iter_download(*args, **kwargs):
+        count['n'] += 1
+        for i, chunk in enumerate([chunk async for chunk in iter_download(*args, **kwargs)]):
+            if count['n'] <= times and i == chunks:
+                return
+            yield chunk
+    client.iter_download = _iter_download
+
+
+def test_download_ended_short_continues(datastore):
+    size = 20 * 1024 * 1024
+    client = FakeClient(chats=1, messages=1, media_ratio=1.0, document_ratio=1.0, media_size=size)
+    _end_short(client, 3, 1)
+    im = datastore.sync(client, resumable_downloads=True)
+    for (path,) in datastore.query('SELECT file from Media'):
+        assert os.path.getsize(path) == size
+    assert im._resumable_done == {}
+
+
+def test_download_ending_without_data_stops_the_run(datastore):
+    size = 20 * 1024 * 1024
+    client = FakeClient(chats=1, messages=2, media_ratio=1.0, document_ratio=1.0, media_size=size)
+    _end_short(client, 0, 100)
+    with pytest.raises(EOFError):
+        datastore.sync(client, resumable_downloads=True)
+    # Nothing saved as a failed download
+    assert datastore.query('SELECT count(*) from Media') == [(0,)]
+    assert datastore.query('SELECT max_message_id from Chat') == [(0,)]
+
+    client = FakeClient(chats=1, messages=2, media_ratio=1.0, document_ratio=1.0, media_size=size)
+    datastore.sync(client, resumable_downloads=True)
+    _assert_complete(datastore, client)
+
+
+def test_same_document_downloaded_once_at_a_time(datastore):
+    size = 17 * 1024 * 1024
+    client = FakeClient(chats=3, messages=30, media_ratio=0.5, document_ratio=1.0, media_size=size, duplicate_ratio=0.8)
+    im = datastore.sync(client, resumable_downloads=True, parallel_chats=3, concurrent_downloads=4)
+    _assert_complete(datastore, client)
+    # Nothing is kept for documents moved into the datastore
+    assert im._resumable_locks == {} and im._resumable_done == {}
+    paths = datastore.query('SELECT file from Media')
+    assert paths
+    for (path,) in paths:
+        assert os.path.getsize(path) == size
+
+
+def _fsck(datastore, client, apply=False):
+    with Importer(client, datastore.folder, datastore.work_folder, check_media_ids=True, fsck_apply=apply):
+        pass
+    with open(os.path.join(datastore.folder, 'fsck.json')) as f:
+        return json.load(f)
+
+
+def test_fsck_dry_run_and_apply(datastore, client):
+    datastore.sync(client)
+    chat_id, media_id, path = datastore.query('SELECT chat_id, media_id, file from Media WHERE file IS NOT NULL ORDER BY media_id LIMIT 1')[0]
+    os.remove(path)
+    orphan = os.path.join(datastore.media_folder, str(chat_id), '99999@orphan.bin')
+    open(orphan, 'w').close()
+    other = os.path.join(datastore.media_folder, str(chat_id), 'notes.txt')
+    open(other, 'w').close()
+
+    result = _fsck(datastore, client)
+    assert result['orphans'] == [orphan]
+    assert result['missing'] == [[chat_id, media_id, path]]
+    assert not result['applied']
+    assert os.path.exists(orphan)
+    assert datastore.query('SELECT file from Media WHERE chat_id=? AND media_id=?', (chat_id, media_id)) == [(path,)]
+
+    result = _fsck(datastore, client, apply=True)
+    assert result['applied']
+    assert not os.path.exists(orphan)
+    assert os.path.exists(other)
+    assert datastore.query('SELECT file from Media WHERE chat_id=? AND media_id=?', (chat_id, media_id)) == [(None,)]
+
+    result = _fsck(datastore, client)
+    assert result['orphans'] == [] and result['missing'] == []
+
+
+def test_fsck_removes_stale_partials(datastore, client):
+    datastore.sync(client)
+    partial_folder = os.path.join(datastore.work_folder, 'partial')
+    os.makedirs(partial_folder)
+    stale = os.path.join(partial_folder, 'document_1')
+    recent = os.path.join(partial_folder, 'document_2')
+    for path in (stale, recent):
+        open(path, 'w').close()
+    week = 7 * 24 * 3600
+    os.utime(stale, (time.time() - week - 60, time.time() - week - 60))
+
+    result = _fsck(datastore, client)
+    assert result['stale_partials'] == [stale]
+    assert os.path.exists(stale)
+
+    result = _fsck(datastore, client, apply=True)
+    assert not os.path.exists(stale)
+    assert os.path.exists(recent)
+
+
+def test_in_place_backup_is_opt_in(datastore, client):
+    backup_path = datastore.db_path + '.backup'
+    datastore.sync(client, in_place_db=True)
+    assert not os.path.exists(backup_path)
+
+    datastore.sync(FakeClient(chats=3, messages=130), in_place_db=True, db_backup=True)
+    # The db as it was before the run
+    db = DataBase(backup_path, read_only=True)
+    assert db.message_count(client.chats[0].id) == 120
+    db.close()
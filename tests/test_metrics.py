@@ -0,0 +1,37 @@
+from benchmarks.fake_client import FakeClient
+from telegram_datamanager.importer import Importer
+from telegram_datamanager.metrics import FloodWaitLogHandler, Metrics
+import logging
+
+import pytest
+
+
+def _flood_wait_handlers():
+    return [handler for handler in logging.getLogger(FloodWaitLogHandler.logger_name).handlers
+            if isinstance(handler, FloodWaitLogHandler)]
+
+
+def test_flood_wait_log_restores_level():
+    logger = logging.getLogger(FloodWaitLogHandler.logger_name)
+    level = logger.level
+    metrics = Metrics()
+    handler = FloodWaitLogHandler(metrics)
+    handler.install()
+    try:
+        logger.info('Sleeping%s for %ds (%s) on %s flood wait', '', 3, '0:00:03', 'GetHistoryRequest')
+    finally:
+        handler.uninstall()
+    assert metrics.counters['flood_waits'] == 1
+    assert logger.level == level
+    assert _flood_wait_handlers() == []
+
+
+def test_flood_wait_log_removed_when_init_fails(datastore):
+    client = FakeClient(chats=1, messages=10)
+
+    async def _rpc(name):
+        raise RuntimeError(name)
+    client._rpc = _rpc
+    with pytest.raises(RuntimeError):
+        Importer(client, datastore.folder, datastore.work_folder)
+    assert _flood_wait_handlers() == []
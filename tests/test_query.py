@@ -0,0 +1,59 @@
+from benchmarks.fake_client import FakeClient
+from telegram_datamanager.query import Query
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+
+def _pages(fetch):
+    # All pages of a paged call, fetch(cursor) returns (items, next cursor)
+    items = []
+    cursor = None
+    while True:
+        page, cursor = fetch(cursor)
+        items += page
+        if cursor is None:
+            return items
+
+
+def test_query_message_pages(datastore):
+    client = FakeClient(chats=2, messages=250)
+    datastore.sync(client)
+    chat_id = client.chats[0].id
+
+    with Query(datastore.folder) as q:
+        messages = _pages(lambda cursor: q.messages(chat_id, cursor=cursor, limit=40))
+        assert [m['message_id'] for m in messages] == list(range(1, 251))
+
+        ranged = _pages(lambda cursor: q.messages(chat_id, date_from=datetime(2020, 1, 1, 1, 0, tzinfo=timezone.utc),
+                                                  date_to=datetime(2020, 1, 1, 2, 0, tzinfo=timezone.utc), cursor=cursor, limit=7))
+        assert [m['message_id'] for m in ranged] == list(range(60, 120))
+
+        # Same page again comes from the cache
+        misses = q.misses
+        q.messages(chat_id, limit=40)
+        assert q.misses == misses and q.hits >= 1
+
+
+def test_query_cache_drops_results_of_changed_chats(datastore):
+    datastore.sync(FakeClient(chats=1, messages=30))
+    chat_id = FakeClient(chats=1).chats[0].id
+
+    with Query(datastore.folder) as q:
+        assert len(_pages(lambda cursor: q.messages(chat_id, cursor=cursor, limit=100))) == 30
+        # Sync into the open datastore while the Query is open
+        datastore.sync(FakeClient(chats=1, messages=45), in_place_db=True)
+        assert len(_pages(lambda cursor: q.messages(chat_id, cursor=cursor, limit=100))) == 45
+
+
+@pytest.mark.parametrize('epoch_dates', [False, True], ids=['text', 'epoch'])
+def test_query_aware_date_range(datastore, epoch_dates):
+    client = FakeClient(chats=1, messages=30)
+    datastore.sync(client, epoch_dates=epoch_dates)
+
+    # Messages 10-19 in UTC+5
+    utc5 = timezone(timedelta(hours=5))
+    with Query(datastore.folder) as q:
+        messages, cursor = q.messages(client.chats[0].id, date_from=datetime(2020, 1, 1, 5, 10, tzinfo=utc5),
+                                      date_to=datetime(2020, 1, 1, 5, 20, tzinfo=utc5), limit=100)
+    assert [m['message_id'] for m in messages] == list(range(10, 20))
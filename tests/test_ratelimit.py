@@ -0,0 +1,153 @@
+from benchmarks.fake_client import FakeClient
+from telegram_datamanager import ratelimit
+from telegram_datamanager.ratelimit import RateLimiter
+from telethon.errors import FloodWaitError
+import asyncio
+import time
+
+import pytest
+
+
+class Clock:
+    # Stands in for the time module of ratelimit, sleeping moves the clock
+    def __init__(self):
+        self.now = 1000.0
+        self.slept = []
+
+    def monotonic(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.slept.append(seconds)
+        self.now += seconds
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(ratelimit, 'time', clock)
+    return clock
+
+
+def _flood(seconds):
+    return FloodWaitError(request=None, capture=seconds)
+
+
+def test_tokens(clock):
+    limiter = RateLimiter({'history': 2}, burst=3)
+    assert [limiter._reserve('history') for _ in range(3)] == [0, 0, 0]
+    assert limiter._reserve('history') == pytest.approx(0.5)
+
+    clock.now += 0.5
+    assert limiter._reserve('history') == 0
+    # Tokens refill up to burst only
+    clock.now += 100
+    assert [limiter._reserve('history') for _ in range(4)][-1] == pytest.approx(0.5)
+
+    # Classes without a rate never wait
+    assert all(limiter._reserve('download') == 0 for _ in range(100))
+
+
+def test_tokens_rounded_below_one(clock):
+    # Refilled tokens can end just under 1, the clock can't move by the remaining wait
+    limiter = RateLimiter({'history': 0.5}, burst=1)
+    limiter._reserve('history')
+    limiter._buckets['history'].tokens = 1 - 1e-14
+    assert limiter._reserve('history') == 0
+
+
+def test_flood_wait_blocks_only_its_class(clock):
+    limiter = RateLimiter({'history': 4, 'download': 4})
+    limiter.flood_wait('history', _flood(10))
+
+    assert limiter._reserve('history') == pytest.approx(10)
+    assert limiter._reserve('download') == 0
+    assert limiter._buckets['history'].rate == 2
+
+    # After the wait, the halved rate starts from an empty bucket
+    clock.now += 10
+    assert limiter._reserve('history') == pytest.approx(0.5)
+
+
+def test_flood_wait_rate_of_unlimited_class(clock):
+    limiter = RateLimiter()
+    for _ in range(11):
+        limiter._reserve('history')
+        clock.now += 0.1
+    limiter.flood_wait('history', _flood(1))
+    assert limiter._buckets['history'].rate == pytest.approx(5)
+
+
+def test_backoff_growth_and_reset(clock):
+    limiter = RateLimiter({'history': 8}, max_retries=3)
+    rates = []
+    for _ in range(3):
+        limiter.flood_wait('history', _flood(1))
+        rates.append(limiter._buckets['history'].rate)
+    assert rates == [4, 2, 1]
+
+    # Successes bring the rate back up to the configured one, and reset the flood count
+    limiter.success('history')
+    assert limiter._buckets['history'].rate == pytest.approx(1.05)
+    for _ in range(100):
+        limiter.success('history')
+    assert limiter._buckets['history'].rate == 8
+    for _ in range(3):
+        limiter.flood_wait('history', _flood(1))
+
+
+def test_raise_after_max_retries(clock):
+    limiter = RateLimiter(max_retries=2)
+    limiter.flood_wait('dialogs', _flood(1))
+    limiter.flood_wait('dialogs', _flood(1))
+    with pytest.raises(FloodWaitError):
+        limiter.flood_wait('dialogs', _flood(1))
+
+
+def test_call_retries_after_flood_wait(clock):
+    limiter = RateLimiter(max_retries=2)
+    errors = [_flood(3), _flood(5)]
+
+    def func(value):
+        if errors:
+            raise errors.pop(0)
+        return value
+
+    assert limiter.call('entities', func, 'ok') == 'ok'
+    assert sum(clock.slept) >= 8
+
+    errors = [_flood(1)] * 3
+    with pytest.raises(FloodWaitError):
+        limiter.call('entities', func, 'ok')
+
+
+def test_other_classes_continue_during_cooldown():
+    limiter = RateLimiter()
+
+    async def run():
+        limiter.flood_wait('history', _flood(1))
+        history = asyncio.ensure_future(limiter.wait('history'))
+        start = time.monotonic()
+        for _ in range(20):
+            await limiter.wait('download')
+        downloads_seconds = time.monotonic() - start
+        await history
+        return downloads_seconds, time.monotonic() - start
+
+    downloads_seconds, history_seconds = asyncio.run(run())
+    assert downloads_seconds < 0.5
+    assert history_seconds >= 0.9
+
+
+@pytest.mark.parametrize('options', [{}, {'parallel_chats': 2}], ids=['serial', 'parallel'])
+def test_history_resumes_after_flood_wait(datastore, options):
+    # Flood waits in the middle of history, each chat needs more pages than are allowed a second
+    client = FakeClient(chats=2, messages=[450, 320], media_ratio=0, flood_waits={'get_history': (3, 1)})
+    im = datastore.sync(client, rate_limiter=RateLimiter(), **options)
+
+    assert client.flood_waits['get_history'] >= 1
+    assert im.metrics.counters['flood_waits'] >= client.flood_waits['get_history']
+    for chat in client.chats:
+        message_ids = [message_id for message_id, in datastore.query(
+            'SELECT message_id from Message WHERE chat_id=? ORDER BY message_id', (chat.id,))]
+        assert message_ids == list(range(1, chat.messages + 1))
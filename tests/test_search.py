@@ -0,0 +1,84 @@
+from benchmarks.fake_client import FakeClient
+from telegram_datamanager.db import DataBase
+from telegram_datamanager import search
+from datetime import datetime, timezone
+import sqlite3
+
+import pytest
+
+
+def test_search_pages(datastore):
+    datastore.sync(FakeClient(chats=2, messages=95))
+    db = DataBase(datastore.db_path)
+    if not db._fts:
+        db.close()
+        pytest.skip('SQLite has no FTS5')
+
+    chat_id = FakeClient(chats=2).chats[1].id
+    results = []
+    page = 0
+    while True:
+        found = db.message_search('"chat 1"', chat_id=chat_id, limit=20, offset=page * 20)
+        if not found:
+            break
+        results += found
+        page += 1
+    db.close()
+
+    assert page == 5
+    assert sorted(message_id for _, message_id, _, _ in results) == list(range(1, 96))
+    assert all(found_chat_id == chat_id for found_chat_id, _, _, _ in results)
+    assert all('[' in snippet for _, _, _, snippet in results)
+
+
+def test_search_date_range(datastore):
+    datastore.sync(FakeClient(chats=1, messages=120))
+    db = DataBase(datastore.db_path)
+    if not db._fts:
+        db.close()
+        pytest.skip('SQLite has no FTS5')
+
+    # Message n is dated n minutes after 2020-01-01
+    results = db.message_search('Message', date_from=datetime(2020, 1, 1, 1, 0, tzinfo=timezone.utc),
+                                date_to=datetime(2020, 1, 1, 1, 30, tzinfo=timezone.utc), limit=100)
+    db.close()
+    assert sorted(message_id for _, message_id, _, _ in results) == list(range(60, 90))
+
+
+def test_interrupted_index_build_is_rebuilt(datastore):
+    datastore.sync(FakeClient(chats=1, messages=30))
+    db = DataBase(datastore.db_path)
+    if not db._fts:
+        db.close()
+        pytest.skip('SQLite has no FTS5')
+    # Empty index of a build that stopped before its version was written
+    with db._conn:
+        db._conn.execute("INSERT into MessageFts (MessageFts) VALUES('delete-all')")
+        db._conn.execute("UPDATE General SET version='V1.7.0'")
+    db.close()
+
+    db = DataBase(datastore.db_path)
+    assert db._version() == DataBase._migrations[-1][0]
+    assert len(db.message_search('Message', limit=100)) == 30
+    db.close()
+
+
+def test_search_main_reads_only(datastore, capsys):
+    datastore.sync(FakeClient(chats=1, messages=30))
+    db = DataBase(datastore.db_path)
+    fts = db._fts
+    db.close()
+    if not fts:
+        pytest.skip('SQLite has no FTS5')
+
+    assert search.main([datastore.folder, 'Message', '--limit', '5']) == 0
+    assert len(capsys.readouterr().out.splitlines()) == 5
+
+    # Migrations are left to a writable open
+    conn = sqlite3.connect(datastore.db_path)
+    with conn:
+        conn.execute("UPDATE General SET version='V1.7.0'")
+    conn.close()
+    with pytest.raises(ValueError):
+        search.main([datastore.folder, 'Message'])
+    assert datastore.query('SELECT version from General') == [('V1.7.0',)]